@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Runs dump.py with HTTPS requests redirected to local stand-in server
+
+    python3 benchmarks/bootstrap.py http://127.0.0.1:8080 dump.py --token x --dump messages
+
+https://{host}/{path} is requested as {server}/{host}/{path} (requests and
+aiohttp), error reports aren't sent. Output may be redirected to a file.
+"""
+import os
+import sys
+import runpy
+
+import requests
+import sentry_sdk
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def redirect(server):
+    def local(url):
+        url = str(url)
+        return server + '/' + url[len('https://'):] if url.startswith('https://') else url
+
+    request = requests.Session.request
+
+    def session_request(self, method, url, *args, **kwargs):
+        return request(self, method, local(url), *args, **kwargs)
+
+    requests.Session.request = session_request
+
+    if aiohttp is not None:
+        _request = aiohttp.ClientSession._request
+
+        def client_request(self, method, url, *args, **kwargs):
+            return _request(self, method, local(url), *args, **kwargs)
+
+        aiohttp.ClientSession._request = client_request
+
+    sentry_sdk.init = lambda *args, **kwargs: None
+
+
+if __name__ == '__main__':
+    server, script = sys.argv[1].rstrip('/'), os.path.abspath(sys.argv[2])
+    redirect(server)
+    # console interface requires terminal
+    os.get_terminal_size = lambda *args: os.terminal_size((120, 40))
+    sys.argv = [script] + sys.argv[3:]
+    sys.path[0] = os.path.dirname(script)
+    runpy.run_path(script, run_name='__main__')
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of dump targets against local stand-in of VK API and CDN
+
+    python3 benchmarks/e2e.py [--dump messages photo ...] [--dialogs 20 --messages 5000] [--size 262144]
+
+Every target is run as a separate `dump.py --dump {target}` process in
+its own temporary folder (benchmarks/vkserver.py serves synthetic data).
+Reported: wall time, API requests (and inner calls of execute),
+media bytes/s and peak RSS of the largest process (Unix only).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import vkserver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOOTSTRAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bootstrap.py')
+
+# audio is loaded by scraping m.vk.com and can't be served
+TARGETS = ('messages', 'attachments_only', 'photo', 'video', 'docs', 'fave_photo', 'fave_video', 'fave_posts')
+
+
+def run(server, target, workdir, log):
+    """Returns (returncode, seconds, peak rss in bytes or None)"""
+    cmd = [sys.executable, BOOTSTRAP, 'http://127.0.0.1:{}'.format(server.server_address[1]),
+           os.path.join(ROOT, 'dump.py'), '--token', 'offline', '--dump', target]
+    start = time.perf_counter()
+    p = subprocess.Popen(cmd, cwd=workdir, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    else:
+        p.wait()
+        rss = None
+    return p.returncode, time.perf_counter() - start, rss
+
+
+def settings(workdir, args):
+    with open(os.path.join(workdir, 'settings.ini'), 'w', encoding='utf-8') as f:
+        f.write('[SETTINGS]\n')
+        f.write('api_rps = {}\n'.format(args.rps))
+        f.write('download_engine = {}\n'.format(args.engine))
+        for s in args.set or []:
+            k, _, v = s.partition('=')
+            f.write('{} = {}\n'.format(k.strip().lower(), v.strip()))
+        f.write('\n[EXCLUDED_DIALOGS]\nid = \n\n[DUMP_DIALOGS_ONLY]\nid = \n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='бенчмарк сохранения данных на локальном сервере API и CDN')
+    parser.add_argument('--dump', type=str, nargs='+', choices=TARGETS, default=list(TARGETS),
+                        help='данные для сохранения')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='число запусков каждой цели в одной папке (повторные - дозапись/синхронизация)')
+    parser.add_argument('--engine', type=str, default='process', choices=('process', 'async'),
+                        help='способ загрузки')
+    parser.add_argument('--rps', type=int, default=0, help='макс. число запросов к API в секунду (0 - без ограничения)')
+    parser.add_argument('--set', type=str, action='append', metavar='KEY=VALUE',
+                        help='значение настройки из settings.ini')
+    parser.add_argument('--keep', action='store_true', help='не удалять папку с результатами')
+    parser.add_argument('--json', action='store_true', help='вывод в JSON')
+    vkserver.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = vkserver.serve(**vkserver.server_kwargs(args))
+    workdir = tempfile.mkdtemp(prefix='vk_dump_bench_')
+
+    results = []
+    with open(os.path.join(workdir, 'dump.log'), 'w') as log:
+        for target in args.dump:
+            folder = os.path.join(workdir, target)
+            os.makedirs(folder)
+            settings(folder, args)
+            for i in range(args.runs):
+                server.reset()
+                log.write('\n===== {} #{} =====\n'.format(target, i + 1))
+                log.flush()
+                code, seconds, rss = run(server, target, folder, log)
+                stats = server.stats()
+                r = {'target': target, 'run': i + 1, 'returncode': code, 'seconds': round(seconds, 3),
+                     'api_requests': sum(stats['api_calls'].values()),
+                     'api_inner_calls': sum(stats['execute_inner_calls'].values()),
+                     'media_bytes_per_sec': round(stats['cdn_bytes'] / seconds),
+                     'peak_rss': rss}
+                r.update(stats)
+                results.append(r)
+
+                if not args.json:
+                    print('{:<18} #{} {:>8.2f} s {:>6} API ({:>6} inner) {:>9.1f} MiB/s {:>8} MiB RSS{}'.format(
+                        target, i + 1, seconds, r['api_requests'], r['api_inner_calls'],
+                        r['media_bytes_per_sec'] / 2**20, round(rss / 2**20) if rss else '-',
+                        '' if code == 0 else ' [код выхода: {}]'.format(code)))
+
+    server.shutdown()
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.keep:
+        print('[результаты: {}]'.format(workdir), file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of message rendering on synthetic histories
+
+    python3 benchmarks/render.py [-n 10000] [-r 3] [-k fwd] [--json]
+
+Reports messages per second (best of repeats) and memory: blocks and bytes
+allocated per message and kept until the page is written (render/*),
+peak of traced memory (dialog/*). No VK account is needed.
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+from modules.messages import MessageRenderer, time_handler  # noqa: E402
+from modules.profiles import Profiles  # noqa: E402
+from modules.utils import DialogFile, zstandard  # noqa: E402
+
+PAGE = 200
+
+
+class Dumper:
+    """Dumper stand-in with profiles of synthetic users"""
+    def __init__(self):
+        self._profiles = Profiles(':memory:', legacy=None)
+        self._profiles.add(synthetic.profiles())
+        self._settings = {'SAVE_DIALOG_ATTACHMENTS': True}
+
+
+def render(dmp, messages, f):
+    """Rendering loop of dialog_handler: messages are written page by page"""
+    renderer = MessageRenderer(dmp)
+    for i in range(0, len(messages), PAGE):
+        for m in messages[i:i+PAGE]:
+            renderer.render(m)
+        renderer.flush(f)
+        for items in renderer.attachments.values():
+            items.clear()
+
+
+def bench_time_handler(dmp, messages):
+    for m in messages:
+        time_handler(m['date'])
+
+
+def bench_render(dmp, messages):
+    render(dmp, messages, io.StringIO())
+
+
+def bench_dialog(compression):
+    def run(dmp, messages):
+        with tempfile.TemporaryDirectory() as tmp:
+            f = DialogFile(os.path.join(tmp, 'dialog' + DialogFile.SUFFIXES[compression]), compression)
+            render(dmp, messages, f)
+            f.close(marker='[last:{}]\n'.format(messages[-1]['id']))
+    return run
+
+
+def retained(dmp, messages):
+    """Returns (blocks, bytes) allocated while rendering one page of all messages"""
+    renderer = MessageRenderer(dmp)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for m in messages:
+        renderer.render(m)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+    return sum(s.count_diff for s in diff), sum(s.size_diff for s in diff)
+
+
+def peak(fn, dmp, messages):
+    """Returns peak of memory traced while fn is running"""
+    tracemalloc.start()
+    fn(dmp, messages)
+    size = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='бенчмарки отрисовки сообщений')
+    parser.add_argument('-n', type=int, default=10000, help='число сообщений')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='число повторов')
+    parser.add_argument('-k', type=str, default='', help='запускать только бенчмарки, содержащие строку')
+    parser.add_argument('--json', action='store_true', help='вывод в JSON')
+    args = parser.parse_args()
+
+    dmp = Dumper()
+    histories = {kind: synthetic.history(args.n, kinds=(kind,)) for kind in synthetic.KINDS}
+    histories['mixed'] = synthetic.history(args.n)
+
+    benchmarks = [('time_handler', bench_time_handler, histories['mixed'])]
+    benchmarks += [('render/' + kind, bench_render, messages) for kind, messages in histories.items()]
+    benchmarks += [('dialog/' + (c or 'txt'), bench_dialog(c), histories['mixed'])
+                   for c in ('', 'gzip', 'zstd') if c != 'zstd' or zstandard is not None]
+
+    results = []
+    for name, fn, messages in benchmarks:
+        if args.k not in name:
+            continue
+        # warm up caches (profiles, dates)
+        fn(dmp, messages[:PAGE])
+
+        best = min(timeit(fn, dmp, messages) for _ in range(args.repeat))
+        r = {'name': name, 'messages': len(messages), 'seconds': round(best, 4),
+             'msg_per_sec': round(len(messages) / best)}
+        if name.startswith('render/'):
+            blocks, size = retained(dmp, messages)
+            r.update(blocks_per_msg=round(blocks / len(messages), 2), bytes_per_msg=round(size / len(messages)))
+        elif name.startswith('dialog/'):
+            r['peak_kib'] = round(peak(fn, dmp, messages) / 1024)
+        results.append(r)
+
+        if not args.json:
+            print('{:<20} {:>10} msg/s {:>8} blocks/msg {:>8} B/msg {:>8} peak KiB'.format(
+                name, r['msg_per_sec'], r.get('blocks_per_msg', '-'), r.get('bytes_per_msg', '-'),
+                r.get('peak_kib', '-')))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+def timeit(fn, dmp, messages):
+    start = time.perf_counter()
+    fn(dmp, messages)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import random
+
+USERS = {i: 'Пользователь {}'.format(i) for i in range(1, 21)}
+GROUPS = {-i: 'Сообщество {}'.format(i) for i in range(1, 6)}
+
+WORDS = ('привет как дела что нового сегодня завтра вчера встреча фото видео '
+         'документ ссылка отпуск билеты поезд самолёт погода работа дом кот').split()
+
+
+def profiles():
+    """Returns [(id, name), ...] of users and groups used by messages"""
+    return list(USERS.items()) + list(GROUPS.items())
+
+
+def text(rnd, lines=1):
+    return '\n'.join(' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12)))
+                     for _ in range(lines))
+
+
+def photo(rnd, n):
+    return {'id': n, 'owner_id': rnd.choice(list(USERS)), 'sizes': [
+        {'type': t, 'width': w, 'height': w*3//4, 'url': 'https://cdn.example/p/{}_{}.jpg'.format(n, t)}
+        for t, w in (('m', 130), ('x', 604), ('y', 807), ('z', 1280), ('s', 75))]}
+
+
+def attachment(rnd, tp, n):
+    """
+    Returns attachment of type handled by MessageRenderer
+
+    tp: attachment type, unknown types are rendered as JSON
+    n: object id
+    """
+    owner = rnd.choice(list(USERS))
+    if tp == 'photo':
+        obj = photo(rnd, n)
+    elif tp == 'video':
+        obj = {'id': n, 'owner_id': owner, 'access_key': 'k{}'.format(n), 'title': text(rnd)}
+    elif tp == 'audio':
+        obj = {'id': n, 'owner_id': owner, 'artist': text(rnd), 'title': text(rnd)}
+    elif tp == 'doc':
+        obj = {'id': n, 'owner_id': owner, 'title': 'doc {}'.format(n), 'ext': 'pdf',
+               'url': 'https://cdn.example/d/{}.pdf'.format(n)}
+    elif tp == 'link':
+        obj = {'title': text(rnd), 'url': 'https://example.com/{}'.format(n)}
+    elif tp == 'market':
+        obj = {'id': n, 'owner_id': -1, 'title': text(rnd),
+               'price': {'amount': str(n * 100), 'currency': {'name': 'RUB'}}}
+    elif tp == 'market_album':
+        obj = {'id': n, 'owner_id': -1, 'title': text(rnd)}
+    elif tp == 'wall':
+        obj = {'id': n, 'to_id': owner}
+    elif tp == 'wall_reply':
+        obj = {'id': n, 'owner_id': -1, 'post_id': n + 1, 'from_id': owner, 'text': text(rnd)}
+    elif tp == 'sticker':
+        obj = {'sticker_id': n, 'images': [{'width': w, 'url': 'https://cdn.example/s/{}_{}.png'.format(n, w)}
+                                           for w in (64, 128, 256)]}
+    elif tp == 'gift':
+        obj = {'id': n}
+    elif tp == 'graffiti':
+        obj = {'id': n, 'owner_id': owner, 'url': 'https://cdn.example/g/{}.png'.format(n)}
+    elif tp == 'audio_message':
+        obj = {'id': n, 'owner_id': owner, 'duration': 5,
+               'link_mp3': 'https://cdn.example/a/{}.mp3'.format(n),
+               'link_ogg': 'https://cdn.example/a/{}.ogg'.format(n)}
+    else:
+        obj = {'id': n, 'owner_id': owner, 'question': text(rnd), 'answers': [text(rnd) for _ in range(3)]}
+    return {'type': tp, tp: obj}
+
+
+ATTACHMENTS = ('photo', 'video', 'audio', 'doc', 'link', 'market', 'market_album', 'wall', 'wall_reply',
+               'sticker', 'gift', 'graffiti', 'audio_message', 'poll')
+
+ACTIONS = ('chat_photo_update', 'chat_photo_remove', 'chat_create', 'chat_title_update', 'chat_invite_user',
+           'chat_kick_user', 'chat_pin_message', 'chat_unpin_message', 'chat_invite_user_by_link')
+
+
+def message(rnd, mid, date, kind, depth=3):
+    """
+    Returns synthetic message object
+
+    kind: plain - multiline text
+          fwd - chain of forwarded messages `depth` levels deep
+          reply - reply to message with text
+          attachments - one attachment of every type
+          action - chat action
+    """
+    m = {'id': mid, 'date': date, 'from_id': rnd.choice(list(USERS)), 'peer_id': 2000000001,
+         'text': '', 'attachments': [], 'fwd_messages': []}
+
+    if kind == 'plain':
+        m['text'] = text(rnd, rnd.randint(1, 3))
+    elif kind == 'fwd':
+        m['text'] = text(rnd)
+        inner = None
+        for level in range(depth):
+            fwd = {'date': date - level - 1, 'from_id': rnd.choice(list(USERS) + list(GROUPS)),
+                   'text': text(rnd, 2), 'attachments': [], 'fwd_messages': [inner] if inner else []}
+            inner = fwd
+        m['fwd_messages'] = [inner, {'date': date - 1, 'from_id': rnd.choice(list(USERS)),
+                                     'text': text(rnd), 'attachments': []}]
+    elif kind == 'reply':
+        m['text'] = text(rnd)
+        m['reply_message'] = {'id': mid - 1, 'date': date - 1, 'from_id': rnd.choice(list(USERS)),
+                              'text': text(rnd, 2), 'attachments': [attachment(rnd, 'photo', mid)]}
+    elif kind == 'attachments':
+        m['attachments'] = [attachment(rnd, tp, mid * 100 + i) for i, tp in enumerate(ATTACHMENTS)]
+    elif kind == 'action':
+        tp = ACTIONS[mid % len(ACTIONS)]
+        m['action'] = {'type': tp, 'member_id': rnd.choice(list(USERS)), 'text': text(rnd),
+                       'conversation_message_id': mid, 'message': text(rnd)}
+        if tp == 'chat_photo_update':
+            m['attachments'] = [attachment(rnd, 'photo', mid)]
+    return m
+
+
+KINDS = ('plain', 'fwd', 'reply', 'attachments', 'action')
+
+
+def history(n, kinds=KINDS, seed=0, start=1262304000, step=97):
+    """
+    Returns n synthetic messages in chronological order
+
+    kinds: kinds of messages, used in turn
+    start: date of the first message
+    step: seconds between messages
+    """
+    rnd = random.Random(seed)
+    return [message(rnd, i + 1, start + i * step, kinds[i % len(kinds)]) for i in range(n)]
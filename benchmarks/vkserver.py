@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+"""
+Local stand-in of VK API and CDN serving synthetic data
+
+    python3 benchmarks/vkserver.py [--port 8080] [--dialogs 10] [--messages 1000] ...
+
+Requests are expected as http://host:port/{original host}/{path}
+(see benchmarks/bootstrap.py): api.vk.com and api.vk.ru - API methods,
+vk.com/video_ext.php - video player pages, any other host - media files
+of configured size (Range requests are supported).
+
+execute is emulated for the scripts of modules/utils.py and VkTools.get_all,
+inner API calls are counted separately.
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import synthetic
+
+API_HOSTS = ('api.vk.com', 'api.vk.ru')
+
+
+class ApiError(Exception):
+    def __init__(self, code, msg):
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+
+
+class World:
+    """
+    Synthetic account: dialogs, photo and video albums, documents, fave
+
+    dialogs: number of dialogs (users and chats in turn)
+    messages: number of messages in every dialog
+    albums: number of photo and video albums
+    photos: number of photos in every album
+    videos: number of videos in every album
+    docs: number of documents
+    fave: number of fave photos, videos and posts
+    """
+    def __init__(self, dialogs=10, messages=1000, albums=2, photos=100, videos=10, docs=50, fave=50, seed=0):
+        self.peers = [2000000001 + i if i % 2 else 100 + i for i in range(dialogs)]
+        self.messages = messages
+        self.albums = albums
+        self.photos = photos
+        self.videos = videos
+        self.docs = docs
+        self.fave = fave
+        self.seed = seed
+        self._history = {}
+        self._lock = threading.Lock()
+
+    def history(self, peer_id):
+        """Returns messages of dialog, oldest first"""
+        with self._lock:
+            if peer_id not in self._history:
+                if peer_id not in self.peers:
+                    raise ApiError(917, 'You don\'t have access to this chat')
+                h = synthetic.history(self.messages, seed=self.seed + peer_id)
+                for m in h:
+                    m['peer_id'] = peer_id
+                self._history[peer_id] = h
+            return self._history[peer_id]
+
+    def rnd(self, *key):
+        return random.Random(repr((self.seed,) + key))
+
+    def photo(self, album_id, n):
+        p = synthetic.photo(self.rnd('photo', album_id, n), album_id * 100000 + n)
+        p.update(owner_id=1, album_id=album_id)
+        return p
+
+    def video(self, owner_id, vid, access_key=None):
+        v = {'id': vid, 'owner_id': owner_id, 'title': 'Видео {}'.format(vid), 'duration': 10,
+             'player': 'https://vk.com/video_ext.php?oid={}&id={}&hash=0'.format(owner_id, vid)}
+        if access_key:
+            v['access_key'] = access_key
+        return v
+
+    def doc(self, n):
+        return {'id': n, 'owner_id': 1, 'title': 'Документ {}'.format(n), 'ext': 'pdf', 'size': 0,
+                'url': 'https://cdn.example/d/{}.pdf'.format(n)}
+
+
+def page(items, offset, count):
+    offset, count = int(offset or 0), int(count or 20)
+    return {'count': len(items), 'items': items[max(offset, 0):max(offset, 0) + count]}
+
+
+class Api:
+    """
+    Implementation of API methods used by the project
+
+    world: World
+    """
+    def __init__(self, world):
+        self.world = world
+        self.calls = Counter()
+        self.inner = Counter()
+        self._lock = threading.Lock()
+
+    def call(self, method, params, inner=False):
+        with self._lock:
+            (self.inner if inner else self.calls)[method] += 1
+        fn = getattr(self, method.replace('.', '_'), None)
+        if fn is None:
+            raise ApiError(3, 'Unknown method passed')
+        return fn(**{k: v for k, v in params.items() if k not in ('v', 'access_token')})
+
+    @staticmethod
+    def _profiles(ids):
+        return [{'id': i, 'first_name': 'Пользователь', 'last_name': str(i)} for i in ids if i > 0]
+
+    @staticmethod
+    def _groups(ids):
+        return [{'id': abs(i), 'name': 'Сообщество {}'.format(abs(i))} for i in ids]
+
+    def _extended(self, items):
+        ids = set()
+        for m in items:
+            ids.add(m['from_id'])
+        return self._profiles(ids), self._groups(i for i in ids if i < 0)
+
+    def account_getProfileInfo(self, **kw):
+        return {'first_name': 'Пользователь', 'last_name': '1', 'screen_name': 'id1'}
+
+    def users_get(self, user_ids='', **kw):
+        return self._profiles(int(i) for i in str(user_ids).split(',') if i)
+
+    def groups_getById(self, group_ids='', **kw):
+        return self._groups(int(i) for i in str(group_ids).split(',') if i)
+
+    def messages_getConversations(self, offset=0, count=20, **kw):
+        items = []
+        for peer in self.world.peers:
+            h = self.world.history(peer)
+            con = {'peer': {'id': peer, 'type': 'chat' if peer > 2000000000 else 'user', 'local_id': peer},
+                   'last_message_id': h[-1]['id'] if h else 0}
+            if peer > 2000000000:
+                con['chat_settings'] = {'title': 'Беседа {}'.format(peer - 2000000000), 'members_count': 20}
+            items.append({'conversation': con, 'last_message': h[-1] if h else {}})
+        r = page(items, offset, count)
+        r['profiles'] = self._profiles(p for p in self.world.peers if p < 2000000000)
+        r['groups'] = []
+        return r
+
+    def messages_getHistory(self, peer_id, offset=0, count=20, rev=0, start_message_id=None, **kw):
+        h = self.world.history(int(peer_id))
+        offset, count = int(offset), int(count)
+        desc = h[::-1]
+        if int(rev):
+            items = h[offset:offset + count]
+        elif start_message_id:
+            # start message position in newest-first order, negative offset - newer messages
+            ids = [m['id'] for m in desc]
+            pos = max(ids.index(int(start_message_id)) + offset, 0)
+            items = desc[pos:pos + count]
+        else:
+            items = desc[offset:offset + count]
+        profiles, groups = self._extended(items)
+        return {'count': len(h), 'items': items, 'profiles': profiles, 'groups': groups}
+
+    def messages_getHistoryAttachments(self, peer_id, media_type='photo', start_from=0, count=30, **kw):
+        items = [{'message_id': m['id'], 'from_id': m['from_id'], 'attachment': at}
+                 for m in reversed(self.world.history(int(peer_id)))
+                 for at in m['attachments'] if at['type'] == media_type]
+        start, count = int(start_from or 0), int(count)
+        r = {'items': items[start:start + count]}
+        if start + count < len(items):
+            r['next_from'] = str(start + count)
+        return r
+
+    def photos_getAlbums(self, **kw):
+        items = [{'id': a, 'title': 'Альбом {}'.format(a), 'size': self.world.photos, 'updated': 1500000000}
+                 for a in range(1, self.world.albums + 1)]
+        return {'count': len(items), 'items': items}
+
+    def photos_get(self, album_id, offset=0, count=50, **kw):
+        items = [self.world.photo(int(album_id), n) for n in range(self.world.photos)]
+        return page(items, offset, count)
+
+    def video_getAlbums(self, offset=0, count=50, **kw):
+        items = [{'id': a, 'title': 'Видеоальбом {}'.format(a), 'count': self.world.videos,
+                  'updated_time': 1500000000} for a in range(1, self.world.albums + 1)]
+        return page(items, offset, count)
+
+    def video_get(self, videos=None, album_id=None, offset=0, count=100, **kw):
+        if videos:
+            items = []
+            for v in videos.split(','):
+                v = v.split('_')
+                items.append(self.world.video(int(v[0]), int(v[1]), v[2] if len(v) > 2 and v[2] else None))
+        else:
+            items = [self.world.video(1, int(album_id or 0) * 100000 + n) for n in range(self.world.videos)]
+        return page(items, offset, count)
+
+    def docs_get(self, **kw):
+        items = [self.world.doc(n) for n in range(1, self.world.docs + 1)]
+        return {'count': len(items), 'items': items}
+
+    def fave_getPhotos(self, offset=0, count=50, **kw):
+        return page([self.world.photo(0, n) for n in range(self.world.fave)], offset, count)
+
+    def fave_getVideos(self, offset=0, count=50, **kw):
+        return page([self.world.video(1, n, 'k{}'.format(n)) for n in range(1, self.world.fave + 1)],
+                    offset, count)
+
+    def fave_getPosts(self, offset=0, count=50, **kw):
+        rnd = self.world.rnd('posts')
+        items = [{'id': n, 'owner_id': -1, 'date': 1500000000 + n, 'text': synthetic.text(rnd),
+                  'attachments': [synthetic.attachment(rnd, tp, n) for tp in ('photo', 'video', 'doc')]}
+                 for n in range(1, self.world.fave + 1)]
+        return page(items, offset, count)
+
+    def execute(self, code, **kw):
+        """
+        Emulates execute scripts of modules/utils.py and VkTools.get_all
+        (up to 25 inner calls)
+        """
+        def arg(pattern, default=None):
+            r = re.search(pattern, code)
+            return r.group(1) if r else default
+
+        def call(method, **params):
+            return self.call(method, params, inner=True)
+
+        method = arg(r'API\.(\w+\.\w+)\(')
+
+        if 'var params' in code:
+            # VkTools.get_all
+            params = json.loads(arg(r'var params = (\{.*?\}),\s*calls'))
+            key = arg(r'response\.(\w+);', 'items')
+            offset, mul = int(arg(r'offset = (-?\d+)')), int(arg(r'offset \* (-?\d+)', '1'))
+            items, count = [], None
+            for _ in range(25):
+                r = call(method, **dict(params, offset=offset * mul))
+                count = r['count']
+                items += r[key]
+                offset += params['count']
+                if len(r[key]) < params['count'] or offset >= count:
+                    return {'count': count, 'items': items, 'offset': offset, 'more': False}
+            return {'count': count, 'items': items, 'offset': offset, 'more': True}
+
+        if method == 'messages.getConversations':
+            offset = int(arg(r'"offset": (\d+)'))
+            ans, profiles, groups = [], [], []
+            for i in range(25):
+                r = call(method, offset=offset, count=200, extended=1)
+                if i and not r['items']:
+                    break
+                ans.append(r['items'])
+                profiles.append(r['profiles'])
+                groups.append(r['groups'])
+                offset += len(r['items'])
+                if not r['items']:
+                    break
+            res = {'count': r['count'], 'items': ans, 'profiles': profiles, 'groups': groups}
+            if r['items']:
+                res['offset'] = offset
+            return res
+
+        if method == 'messages.getHistory':
+            peer_id = int(arg(r'"peer_id": (-?\d+)'))
+            ans, profiles, groups = [], [], []
+            if '"rev": 1' in code:
+                offset = int(arg(r'"offset": (\d+)'))
+                for _ in range(25):
+                    r = call(method, peer_id=peer_id, rev=1, offset=offset, count=200)
+                    offset += len(r['items'])
+                    ans.append(r['items'])
+                    profiles.append(r['profiles'])
+                    groups.append(r['groups'])
+                    if len(r['items']) != 200:
+                        break
+                return {'count': r['count'], 'offset': offset, 'items': ans, 'profiles': profiles, 'groups': groups}
+
+            prev = start = int(arg(r'"start_message_id": (\d+)'))
+            for i in range(25):
+                if i and start <= prev:
+                    break
+                prev = start
+                r = call(method, peer_id=peer_id, start_message_id=prev, offset=-200, count=200)
+                if r['items']:
+                    start = r['items'][0]['id']
+                ans.append(r['items'])
+                profiles.append(r['profiles'])
+                groups.append(r['groups'])
+                if not r['items']:
+                    break
+            return {'count': r['count'], 'items': ans, 'profiles': profiles, 'groups': groups}
+
+        if method == 'messages.getHistoryAttachments':
+            peer_id, media_type = int(arg(r'"peer_id": (-?\d+)')), arg(r'"media_type": "(\w+)"')
+            stop = int(arg(r'last > (\d+)', '0'))
+            r = call(method, peer_id=peer_id, media_type=media_type, start_from=arg(r'"start_from": (\d+)'),
+                     count=200)
+            ans, nxt = [r['items']], r.get('next_from')
+            for _ in range(24):
+                if not r['items'] or r['items'][-1]['message_id'] <= stop or nxt is None:
+                    break
+                r = call(method, peer_id=peer_id, media_type=media_type, start_from=nxt, count=200)
+                if not r['items']:
+                    break
+                nxt = r.get('next_from')
+                ans.append(r['items'])
+            return {'next_from': nxt, 'items': ans} if r['items'] and nxt else {'items': ans}
+
+        if method and method.startswith('fave.'):
+            cnt = int(arg(r'var cnt = (\d+)'))
+            r = call(method, count=cnt)
+            ans, offset = [r['items']], len(r['items'])
+            for _ in range(24):
+                if not r['items']:
+                    break
+                r = call(method, count=cnt, offset=offset)
+                if r['items']:
+                    offset += cnt
+                    ans.append(r['items'])
+            return {'offset': offset, 'items': ans} if r['items'] else {'items': ans}
+
+        raise ApiError(12, 'Unable to compile code')
+
+
+class Server(ThreadingHTTPServer):
+    """
+    HTTP server of API and CDN
+
+    size: size of media files
+    video_size: size of video files
+    latency: delay before response of CDN (seconds)
+    api_latency: delay before response of API (seconds)
+    """
+    daemon_threads = True
+
+    def __init__(self, address, world, size=64*1024, video_size=1024*1024, latency=0, api_latency=0):
+        super().__init__(address, Handler)
+        self.api = Api(world)
+        self.size = size
+        self.video_size = video_size
+        self.latency = latency
+        self.api_latency = api_latency
+        self._data = bytes(range(256)) * (max(size, video_size) // 256 + 1)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Resets counters"""
+        with self._lock:
+            self.api.calls.clear()
+            self.api.inner.clear()
+            self.errors = Counter()
+            self.cdn_requests = 0
+            self.cdn_bytes = 0
+            self.api_bytes = 0
+
+    def count(self, **values):
+        with self._lock:
+            for k, v in values.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def stats(self):
+        return {'api_calls': dict(self.api.calls), 'execute_inner_calls': dict(self.api.inner),
+                'api_errors': dict(self.errors), 'api_bytes': self.api_bytes,
+                'cdn_requests': self.cdn_requests, 'cdn_bytes': self.cdn_bytes}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body, ctype='application/json; charset=utf-8', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _route(self):
+        url = urlsplit(self.path)
+        host, _, path = url.path.lstrip('/').partition('/')
+        return host, '/' + path, url.query
+
+    def do_POST(self):
+        host, path, query = self._route()
+        length = int(self.headers.get('Content-Length') or 0)
+        params = {k: v[-1] for k, v in parse_qs(query).items()}
+        params.update({k: v[-1] for k, v in parse_qs(self.rfile.read(length).decode()).items()})
+        self._api(host, path, params)
+
+    def do_GET(self):
+        host, path, query = self._route()
+        if host in API_HOSTS:
+            return self._api(host, path, {k: v[-1] for k, v in parse_qs(query).items()})
+        if host == 'api.github.com':
+            # no updates
+            return self._send(404, b'{}')
+        if path.startswith('/video_ext.php'):
+            # player page with the source of "vkuservideo" CDN
+            q = parse_qs(query)
+            body = '<video><source src="https://cs1.vkuservideo.net/{}_{}.240.mp4"></video>'.format(
+                q.get('oid', ['0'])[0], q.get('id', ['0'])[0].split('?')[0]).encode()
+            return self._send(200, body, 'text/html')
+        self._media(path)
+
+    do_HEAD = do_GET
+
+    def _api(self, host, path, params):
+        server = self.server
+        if server.api_latency:
+            time.sleep(server.api_latency)
+        method = path[len('/method/'):] if path.startswith('/method/') else ''
+        try:
+            body = {'response': server.api.call(method, params)}
+        except ApiError as e:
+            server.count(errors=Counter({e.code: 1}))
+            body = {'error': {'error_code': e.code, 'error_msg': e.msg,
+                              'request_params': [{'key': 'method', 'value': method}]}}
+        except (KeyError, ValueError, TypeError) as e:
+            server.count(errors=Counter({100: 1}))
+            body = {'error': {'error_code': 100, 'error_msg': 'One of the parameters specified was missing '
+                                                            'or invalid: {!r}'.format(e), 'request_params': []}}
+        data = json.dumps(body, ensure_ascii=False).encode()
+        server.count(api_bytes=len(data))
+        self._send(200, data)
+
+    def _media(self, path):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        size = server.video_size if path.endswith('.mp4') else server.size
+        start, code, headers = 0, 200, [('Accept-Ranges', 'bytes')]
+        r = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+        if r:
+            start = int(r.group(1))
+            if start >= size:
+                headers.append(('Content-Range', 'bytes */{}'.format(size)))
+                return self._send(416, b'', 'application/octet-stream', headers)
+            code = 206
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size)))
+        body = server._data[start:size]
+        server.count(cdn_requests=1, cdn_bytes=len(body) if self.command != 'HEAD' else 0)
+        self._send(code, body, 'application/octet-stream', headers)
+
+
+def serve(port=0, **kwargs):
+    """
+    Starts server in background thread, returns it
+
+    port: 0 - any free port
+    kwargs: World and Server parameters
+    """
+    world_args = {k: kwargs.pop(k) for k in ('dialogs', 'messages', 'albums', 'photos', 'videos', 'docs', 'fave')
+                  if k in kwargs}
+    server = Server(('127.0.0.1', port), World(**world_args), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--dialogs', type=int, default=10, help='число диалогов')
+    parser.add_argument('--messages', type=int, default=1000, help='число сообщений в диалоге')
+    parser.add_argument('--albums', type=int, default=2, help='число альбомов фото и видео')
+    parser.add_argument('--photos', type=int, default=100, help='число фото в альбоме')
+    parser.add_argument('--videos', type=int, default=10, help='число видео в альбоме')
+    parser.add_argument('--docs', type=int, default=50, help='число документов')
+    parser.add_argument('--fave', type=int, default=50, help='число понравившихся фото, видео и постов')
+    parser.add_argument('--size', type=int, default=64*1024, help='размер файлов (байт)')
+    parser.add_argument('--video-size', type=int, default=1024*1024, help='размер видео (байт)')
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа CDN (секунд)')
+    parser.add_argument('--api-latency', type=float, default=0, help='задержка ответа API (секунд)')
+
+
+def server_kwargs(args):
+    return {k: getattr(args, k) for k in ('dialogs', 'messages', 'albums', 'photos', 'videos', 'docs', 'fave',
+                                          'size', 'video_size', 'latency', 'api_latency')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='локальный сервер API и CDN ВК с синтетическими данными')
+    parser.add_argument('--port', type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = serve(args.port, **server_kwargs(args))
+    print('http://127.0.0.1:{}'.format(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
 from configparser import ConfigParser
 
 import os
 import os.path
+import sqlite3
 import sys
 import time
 import importlib
@@ -13,6 +15,13 @@ import requests
 import sentry_sdk
 import vk_api
 
+from modules.api_stats import ApiStats
+from modules.executor import Executor
+from modules.message_store import MessageStore
+from modules.profiles import Profiles
+from modules.profiling import Profiler
+from modules.ratelimit import RateLimiter
+
 NAME = 'VK Dump Tool'
 VERSION = '0.9.10'
 API_VERSION = '5.95'
@@ -513,6 +522,10 @@ class CUI:
 
 class Dumper:
     __modules = None
+    _executor = None
+    _limiter = None
+    _profiler = None
+    _api_stats = None
 
     _AVAILABLE_THREADS = os.cpu_count()
 
@@ -522,11 +535,24 @@ class Dumper:
 
         'POOL_PROCESSES': 4*_AVAILABLE_THREADS,  # макс. число создаваемых процессов
         'LIMIT_VIDEO_PROCESSES': True,  # ограничивать число процессов при загрузке видео?
+        'DOWNLOAD_ENGINE': 'process',  # способ загрузки: process (пул процессов) или async (asyncio, нужен aiohttp)
+        'ASYNC_CONNECTIONS': 256,  # макс. число одновременных загрузок для async
+        'HTTP_POOL_HOSTS': 32,  # число хостов, с которыми сохраняются соединения
+        'HTTP_POOL_PER_HOST': 64,  # макс. число соединений с одним хостом
+        'API_RPS': 3,  # макс. число запросов к API в секунду
+        'MEDIA_STORE': False,  # хранить одинаковые файлы один раз (жёсткие ссылки на dump/.store)?
+        'SYNC_PRUNE': False,  # удалять файлы, удалённые из альбомов, документов и аудио?
 
         'DIALOG_APPEND_MESSAGES': False,  # дописывать новые сообщения в файл вместо полной перезаписи?
+        'DIALOG_COMPRESSION': '',  # сжатие файлов диалогов: пусто (нет), gzip или zstd (нужен zstandard)
+        'SKIP_UNCHANGED_DIALOGS': False,  # пропускать диалоги без новых сообщений (вложения не догружаются)?
+        'MESSAGES_DB': False,  # сохранять сообщения в базу с полнотекстовым поиском (dump/messages.db)?
         'KEEP_DIALOG_NAMES': True,  # сохранять имена файлов в случае изменения имени диалога?
         'SAVE_DIALOG_ATTACHMENTS': True,  # сохранять вложения из диалогов?
-        'HIDE_EXCLUDED_DIALOGS': True
+        'HIDE_EXCLUDED_DIALOGS': True,
+        'DIALOG_WORKERS': 4,  # число одновременно сохраняемых диалогов
+
+        'PROFILES_TTL': 30  # срок хранения имён пользователей в кэше (в днях, 0 - бессрочно)
     }
 
     _settings_names = {
@@ -535,11 +561,24 @@ class Dumper:
 
         'POOL_PROCESSES': 'Число создаваемых процессов при мультипоточной загрузке',
         'LIMIT_VIDEO_PROCESSES': 'Ограничивать число процессов при загрузке видео',
+        'DOWNLOAD_ENGINE': 'Способ загрузки (process - пул процессов, async - asyncio)',
+        'ASYNC_CONNECTIONS': 'Число одновременных загрузок при использовании async',
+        'HTTP_POOL_HOSTS': 'Число хостов, с которыми сохраняются соединения',
+        'HTTP_POOL_PER_HOST': 'Максимальное число соединений с одним хостом',
+        'API_RPS': 'Максимальное число запросов к API в секунду',
+        'MEDIA_STORE': 'Хранить повторяющиеся файлы один раз (жёсткие ссылки на dump/.store)',
+        'SYNC_PRUNE': 'Удалять файлы, удалённые из альбомов, документов и аудио',
 
         'DIALOG_APPEND_MESSAGES': 'Дописывать новые сообщения в файл вместо полной перезаписи',
+        'DIALOG_COMPRESSION': 'Сжатие файлов диалогов (пусто - нет, gzip, zstd)',
+        'SKIP_UNCHANGED_DIALOGS': 'Пропускать диалоги без новых сообщений',
+        'MESSAGES_DB': 'Сохранять сообщения в базу с полнотекстовым поиском (dump/messages.db)',
         'KEEP_DIALOG_NAMES': 'Сохранять название диалога в случае его изменения',
         'SAVE_DIALOG_ATTACHMENTS': 'Сохранять вложения из диалогов',
-        'HIDE_EXCLUDED_DIALOGS': 'Не выводить информацию об исключённых диалогах'
+        'HIDE_EXCLUDED_DIALOGS': 'Не выводить информацию об исключённых диалогах',
+        'DIALOG_WORKERS': 'Число одновременно сохраняемых диалогов',
+
+        'PROFILES_TTL': 'Срок хранения имён пользователей в кэше (в днях, 0 - бессрочно)'
     }
 
     _INVALID_CHARS = ['\\', '/', ':', '*', '?', '<', '>', '|', '"', '$']
@@ -590,11 +629,18 @@ class Dumper:
                 config['DUMP_DIALOGS_ONLY'] = {'id': ','.join([str(i) for i in Dumper._DUMP_DIALOGS_ONLY])}
                 Dumper._settings_save()
 
+        self._profiles = Profiles('users.db', ttl=Dumper._settings['PROFILES_TTL'])
+        atexit.register(self._close)
+
         self._load_modules()
 
     def auth(self, vk_session, interface=None):
         self._interface = self._interface or interface
         self._vk_session = vk_session
+        self._limiter = RateLimiter(self._settings['API_RPS'])
+        self._limiter.install(self._vk_session)
+        if self._api_stats:
+            self._api_stats.install(self._vk_session)
         self._vk = self._vk_session.get_api()
         self._vk_tools = vk_api.VkTools(self._vk)
 
@@ -613,6 +659,76 @@ class Dumper:
             if not m.startswith('__'):
                 self.__setattr__(m, getattr(self.__modules, m))
 
+    def _get_executor(self):
+        """Returns shared executor, creates it on first call"""
+        options = (self._settings['POOL_PROCESSES'],
+                   self._settings['DOWNLOAD_ENGINE'],
+                   self._settings['ASYNC_CONNECTIONS'])
+        if self._executor and self._executor_options != options:
+            self._close()
+        if not self._executor:
+            self._executor = Executor(self.__class__, *options)
+            self._executor_options = options
+        return self._executor
+
+    def _map(self, fn, items, folder, limit=None):
+        """
+        Runs fn(Dumper, item, folder) for each item in shared executor,
+        yields results in order of completion
+
+        limit: max number of simultaneously running tasks
+        """
+        return self._get_executor().map(fn, items, folder, limit)
+
+    def _submit(self, fn, obj, folder, limit=None):
+        """
+        Submits fn(Dumper, obj, folder) to shared executor,
+        returns concurrent.futures.Future
+
+        limit: max number of simultaneously running tasks
+        """
+        return self._get_executor().submit(fn, obj, folder, limit)
+
+    def _close(self):
+        if self._executor:
+            self._executor.close()
+            stats = self._executor.stats
+            if stats['requests']:
+                print('[HTTP: запросов: {}, новых соединений: {}, переиспользовано: {}]'.format(
+                      stats['requests'], stats['connections'], max(0, stats['requests'] - stats['connections'])))
+            self._executor = None
+        if self._limiter:
+            stats = self._limiter.stats
+            if stats['throttled']:
+                print('[API: запросов: {}, превышений лимита: {}, повторов: {}, ошибок: {}]'.format(
+                      stats['requests'], stats['throttled'], stats['retries'], stats['failed']))
+
+    def _search(self, query, limit=50):
+        """
+        Prints messages found in dump/messages.db
+
+        query: FTS query
+        limit: max number of messages
+        """
+        path = os.path.join('dump', 'messages.db')
+        if not os.path.exists(path):
+            print('[база сообщений не найдена, включите настройку MESSAGES_DB и сохраните сообщения]')
+            return
+
+        store = MessageStore(path)
+        try:
+            found = store.search(query, limit=limit)
+        except sqlite3.OperationalError as e:
+            print('[ошибка в запросе: {}]'.format(e))
+            return
+        finally:
+            store.close()
+
+        for peer_id, mid, from_id, date, text in found:
+            print('[{}] {} | {}: {}'.format(time.strftime('%d.%m.%Y %H:%M', time.gmtime(date)),
+                                            peer_id, self._profiles.get(from_id, {'name': from_id})['name'], text))
+        print('[найдено сообщений: {}]'.format(len(found)))
+
     @staticmethod
     def _settings_save():
         config = ConfigParser()
@@ -623,16 +739,40 @@ class Dumper:
             config['DUMP_DIALOGS_ONLY'] = {'id': ','.join([str(i) for i in Dumper._DUMP_DIALOGS_ONLY])}
             config.write(cf)
 
+    def _run(self, func):
+        """
+        Runs dump function, it is profiled if --profile is set
+
+        func: dump function
+        """
+        if not self._profiler:
+            return func(self)
+        with self._profiler.target(func.__name__):
+            return func(self)
+
+    def _save_profile(self):
+        if self._profiler:
+            self._profiler.save()
+            print('[профиль сохранён: {}]'.format(self._profiler._path))
+
+    def _close_api_stats(self):
+        if self._api_stats:
+            self._api_stats.close()
+            if self._api_stats.methods:
+                print('[API: статистика вызовов]')
+                for line in self._api_stats.table():
+                    print('  ' + line)
+
     def _dump_all(self):
         for name, func in inspect.getmembers(self):
             if name.startswith('dump_'):
-                func(self)
+                self._run(func)
                 print()
 
     def _dump_all_fave(self):
         for name, func in inspect.getmembers(self):
             if name.startswith('dump_fave_'):
-                func(self)
+                self._run(func)
                 print()
 
 # ----------------------------------------------------------------------------
@@ -667,10 +807,43 @@ if __name__ == '__main__':
     dump.add_argument('--dump', type=str, nargs='*',
                       choices=ch.keys(),
                       help='Данные для сохранения.')
+    search = parser.add_argument_group('Поиск')
+    search.add_argument('--search', type=str, metavar='\b',
+                        help='поиск по сохранённым сообщениям (настройка MESSAGES_DB)')
+    search.add_argument('--limit', type=int, default=50, metavar='\b',
+                        help='максимальное число найденных сообщений')
+    profile = parser.add_argument_group('Профилирование')
+    profile.add_argument('--profile', type=str, nargs='?', const='profile.json', metavar='PATH',
+                         help='сохранить время и пиковое потребление памяти этапов сохранения (по умолчанию profile.json)')
+    profile.add_argument('--cprofile', action='store_true',
+                         help='также сохранить статистику cProfile каждой цели ({PATH}_{цель}.prof), '
+                              'диалоги сохраняются по одному')
+
+    api = parser.add_argument_group('Статистика API')
+    api.add_argument('--api-stats', action='store_true',
+                     help='вывести число вызовов, задержки, размер ответов и ошибки методов API в конце работы')
+    api.add_argument('--api-stats-log', type=str, metavar='PATH',
+                     help='периодически дописывать статистику вызовов API в файл (JSON lines)')
+    api.add_argument('--api-stats-interval', type=int, default=10, metavar='\b',
+                     help='период записи статистики в секундах (по умолчанию 10)')
 
     cli_args = parser.parse_args()
     # end of cli
 
+    if cli_args.profile or cli_args.cprofile:
+        dmp._profiler = Profiler(cli_args.profile or 'profile.json', cprofile=cli_args.cprofile)
+        atexit.register(dmp._save_profile)
+        if cli_args.cprofile and dmp._settings['DIALOG_WORKERS'] > 1:
+            print('[cProfile: диалоги будут сохраняться по одному]')
+
+    if cli_args.api_stats or cli_args.api_stats_log:
+        dmp._api_stats = ApiStats(cli_args.api_stats_log, cli_args.api_stats_interval)
+        atexit.register(dmp._close_api_stats)
+
+    if cli_args.search:
+        dmp._search(cli_args.search, cli_args.limit)
+        raise SystemExit
+
     cui = CUI()
     cui.update(dmp, quite=(cli_args.dump or cli_args.update))
 
@@ -685,7 +858,7 @@ if __name__ == '__main__':
         else:
             cui.login(dmp)
             for d in cli_args.dump:
-                ch.get(d)(dmp)
+                dmp._run(ch.get(d))
             print()
     else:
         cui.welcome()
@@ -704,7 +877,7 @@ if __name__ == '__main__':
                                               'q': {'name': 'Выход', 'action': cui.goodbye}})
             if fun:
                 if fun.__name__.startswith('dump_'):
-                    if not fun(dmp) is False:
+                    if not dmp._run(fun) is False:
                         print('\n{clr}Сохранение завершено :з{nc}'.format(
                               clr=cui._colors['green'], nc=cui._mods['nc']))
                         print('\n[нажмите {clr}Enter{nc} для продолжения]'.format(
@@ -2,11 +2,22 @@ __all__ = []
 
 import pkgutil
 import inspect
+import importlib
+
+# exported after all modules are loaded: importing submodule
+# (e.g. modules._download) replaces function of the same name
+_members = {}
 
 for loader, filename, is_pkg in pkgutil.walk_packages(__path__):
-    module = loader.find_module(filename).load_module(filename)
+    # imported as modules.{name}, so functions exported here and
+    # imported by other modules come from the same module object
+    module = importlib.import_module('{}.{}'.format(__name__, filename))
 
     for name, value in inspect.getmembers(module):
-        if name.startswith('dump') or name.startswith('_download'):
-            globals()[name] = value
-            __all__.append(name)
+        if (name.startswith('dump') or name.startswith('_download')) and not inspect.ismodule(value):
+            _members[name] = value
+
+globals().update(_members)
+__all__.extend(_members)
+
+del _members
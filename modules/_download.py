@@ -1,34 +1,98 @@
+import asyncio
+import hashlib
 import logging
 
 import os
 import os.path
 import requests
+import requests.adapters
 import shutil
+import threading
+import tracemalloc
 import urllib3
 
-from urllib.request import urlopen
 from re import search as research
 
 from youtube_dl import YoutubeDL
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 logger = logging.Logger(name='youtube-dl', level=logging.FATAL)
 
+_session = None  # HTTP session of current process
+_stats = None  # shared counters [requests, new connections]
 
-def _download(dmp, obj, folder, **kwargs):
+
+def _init_worker(stats):
     """
+    Initializer of download processes
+
+    stats: shared array [requests, new connections]
+    """
+    global _stats
+    _stats = stats
+    # tracing of --profile is inherited by forked processes,
+    # only memory of the main process is reported
+    tracemalloc.stop()
+
+
+def _get_session(dmp):
+    """
+    Returns HTTP session of current process
+    with keep-alive connection pools
+
     dmp: Dumper class
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=dmp._settings['HTTP_POOL_HOSTS'],
+                                                pool_maxsize=dmp._settings['HTTP_POOL_PER_HOST'])
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
 
-    possible kwargs:
-        name: force filename
-        ext: force file extension
-        prefix: {prefix}_...
-        access_key: get request with access_key
-        force: overwrite file if it exists
-        text_mode: write in text mode
+
+def _connections(session):
+    """Returns number of connections opened by session's pools"""
+    n = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                n += pool.num_connections
+    return n
+
+
+def _get(dmp, url, **kwargs):
     """
-    if not obj:
-        return False
+    GET request using session of current process, counts connections reuse
+
+    dmp: Dumper class
+    """
+    session = _get_session(dmp)
+    if _stats is None:
+        return session.get(url, **kwargs)
+
+    before = _connections(session)
+    r = session.get(url, **kwargs)
+    with _stats.get_lock():
+        _stats[0] += 1
+        _stats[1] += max(0, _connections(session) - before)
+    return r
+
 
+def _target(dmp, obj, folder, **kwargs):
+    """
+    Returns (url, path, kwargs) of download object
+
+    dmp: Dumper class
+    obj: url or object {url, ...kwargs}
+    """
     if isinstance(obj, str):
         url = obj
         del obj
@@ -36,7 +100,7 @@ def _download(dmp, obj, folder, **kwargs):
         url = obj.get('url')
         # obj -> kwargs
         for prop in ('name', 'ext', 'prefix', 'access_key',
-                     'force', 'text_mode'):
+                     'force', 'text_mode', 'key'):
             kwargs.update({
                 prop: obj.get(prop) or kwargs.get(prop)
             })
@@ -63,16 +127,185 @@ def _download(dmp, obj, folder, **kwargs):
         while len(os.path.join(folder, fn).encode('utf-8')) > 255:
             fn = fn[:len(fn)-len(ext)-1][:-1] + f'.{ext}'
 
-    if not os.path.exists(os.path.join(folder, fn)) or kwargs.get('force'):
+    return url, os.path.join(folder, fn), kwargs
+
+
+def _part(path):
+    """
+    Returns (path of .part file, size of already downloaded part)
+    """
+    part = path + '.part'
+    try:
+        return part, os.path.getsize(part)
+    except OSError:
+        return part, 0
+
+
+def _part_ok(status, offset):
+    """
+    Checks that response has content of the file: 200 or
+    206 (Partial Content) for Range request, error pages aren't saved
+
+    status: HTTP status code
+    offset: size of already downloaded part (Range is requested if > 0)
+    """
+    return status == 200 or (status == 206 and offset > 0)
+
+
+def _part_size(status, headers, offset):
+    """
+    Returns (offset, size) of .part file for response:
+        offset is reset if server ignored Range,
+        size is None if it can't be verified
+
+    status: HTTP status code
+    headers: response headers
+    offset: size of already downloaded part
+    """
+    if status != 206:
+        offset = 0
+    length = headers.get('Content-Length')
+    if not length or not length.isdigit() or headers.get('Content-Encoding', 'identity') != 'identity':
+        return offset, None
+    return offset, offset + int(length)
+
+
+def _part_check(part, size):
+    """
+    Checks that .part file is complete, incomplete part is kept for resume
+    """
+    return size is None or os.path.getsize(part) == size
+
+
+def _part_416(part, path, offset, headers):
+    """
+    Handles "Range Not Satisfiable": part is either complete or broken
+    """
+    total = headers.get('Content-Range', '').split('/')[-1]
+    if total.isdigit() and int(total) == offset:
+        os.replace(part, path)
+        return True
+    os.remove(part)
+    return False
+
+
+def _store(dmp):
+    """
+    Returns root of media store or None if it is disabled
+
+    Store keeps one copy of each file:
+        sha256/{xx}/{hash} - stored files
+        by-id/{key} - links to files of known VK objects
+    Dumped files are hardlinks to stored ones
+    """
+    return os.path.join('dump', '.store') if dmp._settings['MEDIA_STORE'] else None
+
+
+def _link(src, dst):
+    """
+    Atomically replaces dst with hardlink to src,
+    file is copied if hardlinks aren't supported
+    """
+    tmp = '{}.{}_{}.link'.format(dst, os.getpid(), threading.get_ident())
+    try:
+        os.link(src, tmp)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _store_get(dmp, key, path):
+    """
+    Links stored object to path, returns False if object is unknown
+
+    key: VK object identity ({type}{owner_id}_{id})
+    """
+    store = _store(dmp)
+    if not store or not key:
+        return False
+    try:
+        _link(os.path.join(store, 'by-id', key), path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _store_put(dmp, key, part):
+    """
+    Adds downloaded file to store, file is replaced
+    with link if the same content is already stored
+
+    key: VK object identity or None
+    part: downloaded file
+    """
+    store = _store(dmp)
+    if not store:
+        return
+
+    h = hashlib.sha256()
+    with open(part, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            h.update(chunk)
+    h = h.hexdigest()
+
+    obj = os.path.join(store, 'sha256', h[:2], h)
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    if os.path.exists(obj):
+        _link(obj, part)
+    else:
+        _link(part, obj)
+
+    if key:
+        os.makedirs(os.path.join(store, 'by-id'), exist_ok=True)
+        _link(obj, os.path.join(store, 'by-id', key))
+
+
+def _download(dmp, obj, folder, **kwargs):
+    """
+    dmp: Dumper class
+
+    possible kwargs:
+        name: force filename
+        ext: force file extension
+        prefix: {prefix}_...
+        access_key: get request with access_key
+        force: overwrite file if it exists
+        text_mode: write in text mode
+        key: VK object identity for media store
+    """
+    if not obj:
+        return False
+
+    url, path, kwargs = _target(dmp, obj, folder, **kwargs)
+
+    if not os.path.exists(path) or kwargs.get('force'):
+        if not kwargs.get('force') and _store_get(dmp, kwargs.get('key'), path):
+            return True
+
+        part, offset = _part(path)
         try:
             if kwargs.get('text_mode'):
-                r = requests.get(url, timeout=(30, 5))
-                with open(os.path.join(folder, fn), 'w', encoding='utf-8') as f:
-                    f.write(r.text)
+                with _get(dmp, url, timeout=(30, 5)) as r:
+                    if r.status_code != 200:
+                        return False
+                    with open(part, 'w', encoding='utf-8') as f:
+                        f.write(r.text)
             else:
-                r = requests.get(url, stream=True, timeout=(30, 5))
-                with open(os.path.join(folder, fn), 'wb') as f:
-                    shutil.copyfileobj(r.raw, f)
+                headers = {'Range': f'bytes={offset}-'} if offset else None
+                with _get(dmp, url, headers=headers, stream=True, timeout=(30, 5)) as r:
+                    if r.status_code == 416:
+                        return _part_416(part, path, offset, r.headers)
+                    if not _part_ok(r.status_code, offset):
+                        return False
+                    offset, size = _part_size(r.status_code, r.headers, offset)
+                    with open(part, 'ab' if offset else 'wb') as f:
+                        shutil.copyfileobj(r.raw, f)
+                if not _part_check(part, size):
+                    return False
+                _store_put(dmp, kwargs.get('key'), part)
+            os.replace(part, path)
             return True
         except requests.exceptions.ConnectionError:
             return False
@@ -80,20 +313,86 @@ def _download(dmp, obj, folder, **kwargs):
             return False
         except urllib3.exceptions.ReadTimeoutError:
             return False
+        except urllib3.exceptions.ProtocolError:
+            return False
         except Exception as e:
             raise e
     else:
         return True
 
 
+def _doc_kwargs(d):
+    """
+    Returns _download kwargs of doc object
+    """
+    return {'name': f'{d.get("title")}_{d.get("id")}',
+            'ext': d.get('ext'),
+            'key': f'doc{d.get("owner_id")}_{d.get("id")}'}
+
+
 def _download_doc(dmp, d, folder):
-    return _download(
-        dmp,
-        d,
-        folder,
-        name=f'{d.get("title")}_{d.get("id")}',
-        ext=d.get('ext')
-    )
+    return _download(dmp, d, folder, **_doc_kwargs(d))
+
+
+def _video_player(v):
+    """
+    Returns player url of video object
+    """
+    if 'height' not in v:
+        v['height'] = 480 if 'photo_800' in v else \
+                      360 if 'photo_320' in v else \
+                      240
+
+    return v['player'] if ('access_key' not in v) else f"{v['player']}?access_key={v['access_key']}"
+
+
+def _video_source(v, data):
+    """
+    Returns mp4 url found in player page or None
+
+    v: video object
+    data: player page (bytes)
+    """
+    try:
+        return research(b'https://cs.*vkuservideo.*'
+                        + str(min(v['height'], v['width']) if ('width' in v) else v['height']).encode()
+                        + b'.mp4', data).group(0).decode()
+    except AttributeError:
+        return None
+
+
+def _video_kwargs(v):
+    """
+    Returns _download kwargs of video object
+    """
+    return {'name': v['title'] + '_' + str(v['id']),
+            'ext': 'mp4',
+            'key': f"video{v['owner_id']}_{v['id']}"}
+
+
+def _video_stored(dmp, v, folder):
+    """
+    Returns True if video is already downloaded or found in media store
+    """
+    _, path, kwargs = _target(dmp, v['player'], folder, **_video_kwargs(v))
+    return os.path.exists(path) or _store_get(dmp, kwargs['key'], path)
+
+
+def _path(dmp, fn, obj, folder):
+    """
+    Returns path of file saved by fn(dmp, obj, folder),
+    None if it is unknown (external videos)
+
+    fn: download function
+    """
+    if fn.__name__ == '_download_video':
+        if 'platform' in obj or 'player' not in obj:
+            return None
+        return _target(dmp, obj['player'], folder, **_video_kwargs(obj))[1]
+    elif fn.__name__ == '_download_doc':
+        return _target(dmp, obj, folder, **_doc_kwargs(obj))[1]
+    else:
+        return _target(dmp, obj, folder)[1]
 
 
 def _download_video(dmp, v, folder):
@@ -105,23 +404,20 @@ def _download_video(dmp, v, folder):
     else:
         if 'player' not in v:
             return False
-        if 'height' not in v:
-            v['height'] = 480 if 'photo_800' in v else \
-                          360 if 'photo_320' in v else \
-                          240
+        if _video_stored(dmp, v, folder):
+            return True
 
-        url = v['player'] if ('access_key' not in v) else f"{v['player']}?access_key={v['access_key']}"
-        data = urlopen(url).read()
         try:
-            return _download(dmp,
-                             research(b'https://cs.*vkuservideo.*'
-                                      + str(min(v['height'], v['width']) if ('width' in v) else v['height']).encode()
-                                      + b'.mp4', data).group(0).decode(),
-                             folder,
-                             name=v['title'] + '_' + str(v['id']),
-                             ext='mp4')
-        except AttributeError:
+            with _get(dmp, _video_player(v), timeout=(30, 5)) as r:
+                if r.status_code != 200:
+                    return False
+                data = r.content
+        except requests.exceptions.RequestException:
+            return False
+        url = _video_source(v, data)
+        if not url:
             return False
+        return _download(dmp, url, folder, **_video_kwargs(v))
 
 
 def _download_external(url, folder):
@@ -146,3 +442,88 @@ def _download_external(url, folder):
                       'progress_hooks': (hook,)
                     }).download((url,)):
         return r
+
+
+async def _adownload(session, dmp, obj, folder, **kwargs):
+    """
+    Asynchronous version of _download
+
+    session: aiohttp.ClientSession
+    dmp: Dumper class
+    """
+    if not obj:
+        return False
+
+    url, path, kwargs = _target(dmp, obj, folder, **kwargs)
+
+    if not os.path.exists(path) or kwargs.get('force'):
+        if not kwargs.get('force') and _store_get(dmp, kwargs.get('key'), path):
+            return True
+
+        part, offset = _part(path)
+        try:
+            if kwargs.get('text_mode'):
+                async with session.get(url, timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=5)) as r:
+                    if r.status != 200:
+                        return False
+                    text = await r.text()
+                with open(part, 'w', encoding='utf-8') as f:
+                    f.write(text)
+            else:
+                headers = {'Range': f'bytes={offset}-'} if offset else None
+                async with session.get(url, headers=headers,
+                                       timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=5)) as r:
+                    if r.status == 416:
+                        return _part_416(part, path, offset, r.headers)
+                    if not _part_ok(r.status, offset):
+                        return False
+                    offset, size = _part_size(r.status, r.headers, offset)
+                    with open(part, 'ab' if offset else 'wb') as f:
+                        async for chunk in r.content.iter_chunked(64*1024):
+                            f.write(chunk)
+                if not _part_check(part, size):
+                    return False
+                # hashing doesn't block other transfers
+                await asyncio.get_running_loop().run_in_executor(None, _store_put, dmp, kwargs.get('key'), part)
+            os.replace(part, path)
+            return True
+        except aiohttp.ClientError:
+            return False
+        except asyncio.TimeoutError:
+            return False
+    else:
+        return True
+
+
+async def _adownload_doc(session, dmp, d, folder):
+    return await _adownload(session, dmp, d, folder, **_doc_kwargs(d))
+
+
+async def _adownload_video(session, dmp, v, folder):
+    """
+    Asynchronous version of _download_video,
+    external videos are downloaded in default thread pool
+    """
+    if 'platform' in v:
+        return await asyncio.get_running_loop().run_in_executor(None, _download_external, v['player'], folder)
+    else:
+        if 'player' not in v:
+            return False
+        if _video_stored(dmp, v, folder):
+            return True
+
+        try:
+            async with session.get(_video_player(v),
+                                   timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=5)) as r:
+                if r.status != 200:
+                    return False
+                data = await r.read()
+        except aiohttp.ClientError:
+            return False
+        except asyncio.TimeoutError:
+            return False
+
+        url = _video_source(v, data)
+        if not url:
+            return False
+        return await _adownload(session, dmp, url, folder, **_video_kwargs(v))
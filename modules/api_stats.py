@@ -0,0 +1,211 @@
+import re
+import json
+import time
+import threading
+
+from vk_api.exceptions import ApiError, ApiHttpError
+
+# upper bounds of latency histogram buckets in milliseconds
+BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# first method called by execute script
+_EXECUTE_METHOD = re.compile(r'API\.(\w+\.\w+)')
+# page size of VkTools.get_all script
+_EXECUTE_COUNT = re.compile(r'"count":\s*(\d+)')
+
+
+class ApiStats:
+    """
+    Statistics of VK API calls made through one session
+
+    Collected per method (execute requests as "execute:{first method of script}"):
+        calls, seconds - time of HTTP requests (without waiting for rate limit),
+        histogram - number of calls by latency (BUCKETS, the last one is slower),
+        bytes - size of responses, errors - {code: n},
+        retries - calls repeated by error handlers (e.g. "Too many requests"),
+        inner - pages received by execute (calls of API methods in script)
+
+    log: file to append statistics to as JSON lines
+    interval: period of writing to log in seconds
+    """
+    def __init__(self, log=None, interval=10):
+        self.log = log
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._methods = {}
+        self._started = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def install(self, vk_session):
+        """
+        Wraps vk_session.method and its error handlers,
+        should be called after RateLimiter.install
+
+        vk_session: vk_api.VkApi
+        """
+        method = vk_session.method
+
+        def measured(name, values=None, *args, **kwargs):
+            local = self._local
+            if getattr(local, 'call', None) is not None:
+                # repeated by error handler, accounted in the outer call
+                local.call['retries'] += 1
+                return method(name, values, *args, **kwargs)
+
+            call = local.call = {'retries': 0, 'errors': set()}
+            seconds, size = self._received()
+            error = None
+            response = None
+            try:
+                response = method(name, values, *args, **kwargs)
+                return response
+            except ApiHttpError:
+                error = 'http'
+                raise
+            except ApiError as e:
+                error = e.code
+                raise
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                local.call = None
+                seconds, size = (a - b for a, b in zip(self._received(), (seconds, size)))
+                if error is not None:
+                    call['errors'].add(error)
+                if name == 'execute':
+                    code = (values or {}).get('code', '')
+                    found = _EXECUTE_METHOD.search(code)
+                    name = 'execute:' + (found.group(1) if found else '?')
+                    if kwargs.get('raw') and response:
+                        response = response.get('response')
+                    inner = _inner_calls(code, response)
+                else:
+                    inner = 0
+                self._add(name, seconds, size, call, inner)
+
+        vk_session.method = measured
+
+        for code, handler in list(vk_session.error_handlers.items()):
+            vk_session.error_handlers[code] = self._handler(code, handler)
+
+        vk_session.http.hooks['response'].append(self._response)
+
+        if self.log and self._thread is None:
+            self._thread = threading.Thread(target=self._write_log, daemon=True)
+            self._thread.start()
+
+    def _handler(self, code, handler):
+        def handled(error):
+            call = getattr(self._local, 'call', None)
+            if call is not None:
+                call['errors'].add(code)
+            return handler(error)
+        return handled
+
+    def _response(self, r, *args, **kwargs):
+        local = self._local
+        local.seconds = getattr(local, 'seconds', 0.0) + r.elapsed.total_seconds()
+        local.bytes = getattr(local, 'bytes', 0) + len(r.content)
+
+    def _received(self):
+        """Returns (seconds, bytes) of HTTP responses received by current thread"""
+        return getattr(self._local, 'seconds', 0.0), getattr(self._local, 'bytes', 0)
+
+    def _add(self, name, seconds, size, call, inner):
+        with self._lock:
+            m = self._methods.get(name)
+            if m is None:
+                m = self._methods[name] = {'calls': 0, 'seconds': 0.0, 'max': 0.0,
+                                           'histogram': [0] * (len(BUCKETS) + 1),
+                                           'bytes': 0, 'errors': {}, 'retries': 0, 'inner': 0}
+            m['calls'] += 1
+            m['seconds'] += seconds
+            m['max'] = max(m['max'], seconds)
+            m['histogram'][_bucket(seconds)] += 1
+            m['bytes'] += size
+            m['retries'] += call['retries']
+            m['inner'] += inner
+            for code in call['errors']:
+                m['errors'][code] = m['errors'].get(code, 0) + 1
+
+    @property
+    def methods(self):
+        """{method: {calls, seconds, max, histogram, bytes, errors, retries, inner}}"""
+        with self._lock:
+            return {name: dict(m, histogram=list(m['histogram']), errors=dict(m['errors']),
+                               seconds=round(m['seconds'], 4), max=round(m['max'], 4))
+                    for name, m in self._methods.items()}
+
+    def snapshot(self, final=False):
+        """Returns object written to log"""
+        return {'time': int(time.time()), 'uptime': round(time.time() - self._started, 1),
+                'final': final, 'buckets': BUCKETS, 'methods': self.methods}
+
+    def _write_log(self):
+        while not self._stop.wait(self.interval):
+            self._append(self.snapshot())
+
+    def _append(self, obj):
+        with open(self.log, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(obj, ensure_ascii=False) + '\n')
+
+    def close(self):
+        """Stops periodic writing, the final statistics are written to log"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.log:
+            self._append(self.snapshot(final=True))
+
+    def table(self):
+        """Returns lines of summary table, methods with the longest total time first"""
+        methods = sorted(self.methods.items(), key=lambda m: m[1]['seconds'], reverse=True)
+        lines = ['{:<40} {:>7} {:>7} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8}  {}'.format(
+                 'метод', 'вызовов', 'внутр.', 'повтор.', 'КиБ', 'ср. мс', 'p50 мс', 'p95 мс', 'макс. мс', 'ошибки')]
+        for name, m in methods:
+            lines.append('{:<40} {:>7} {:>7} {:>7} {:>9.1f} {:>8.1f} {:>8} {:>8} {:>8.1f}  {}'.format(
+                name[:40], m['calls'], m['inner'] or '-', m['retries'] or '-', m['bytes'] / 1024,
+                m['seconds'] / m['calls'] * 1000, _percentile(m['histogram'], 0.5),
+                _percentile(m['histogram'], 0.95), m['max'] * 1000,
+                ', '.join('{}: {}'.format(c, n) for c, n in m['errors'].items()) or '-'))
+        return lines
+
+
+def _bucket(seconds):
+    ms = seconds * 1000
+    for i, b in enumerate(BUCKETS):
+        if ms <= b:
+            return i
+    return len(BUCKETS)
+
+
+def _percentile(histogram, q):
+    """Returns upper bound of bucket containing q-th part of calls"""
+    n = sum(histogram) * q
+    total = 0
+    for i, c in enumerate(histogram):
+        total += c
+        if c and total >= n:
+            return '≤{}'.format(BUCKETS[i]) if i < len(BUCKETS) else '>{}'.format(BUCKETS[-1])
+    return '-'
+
+
+def _inner_calls(code, response):
+    """
+    Returns number of pages received by execute script
+
+    Scripts of modules.utils return pages as arrays in "items",
+    VkTools.get_all returns all items in one array
+    """
+    if not isinstance(response, dict) or not isinstance(response.get('items'), list):
+        return 1
+    items = response['items']
+    if items and all(isinstance(i, list) for i in items):
+        return len(items)
+    found = _EXECUTE_COUNT.search(code)
+    count = int(found.group(1)) if found else 0
+    return max(1, -(-len(items) // count)) if count else 1
@@ -1,172 +1,115 @@
 import os
 import os.path
-import json
-import shutil
-import itertools
-from multiprocess import Pool
 from multiprocess.pool import MaybeEncodingError
 from operator import itemgetter
 
-from modules.utils import get_attachments
+from modules.profiling import stage
+from modules.state import load_state, update_state
+from modules.utils import DialogFiles, get_attachments, get_conversations, save_dialogs
 
-users = {}
-if os.path.exists('users.json'):
-    with open('users.json', 'r', encoding='utf-8') as f:
-        users = json.load(f)
 
-
-def users_add(vk, pid, **kwargs):
-    """
-    Gets user's info and add it to users object
-
-    vk: vk_api
-    pid: profile id
-
-    possible kwargs:
-        throw - don't handle AttributeError exception if it occurs again
+def attachments_handler(dmp, con, folder, out=print, files=None):
     """
-    global users
-    try:
-        if pid > 0:
-            # User: {..., first_name, last_name, pid, ...} ->
-            #       {pid:{name: 'first_name + last_name', length: len(name)}
-            u = vk.users.get(user_ids=pid)[0]
-            if (u.get('deactivated') == 'deleted') and (u['first_name'] == 'DELETED'):
-                name = 'DELETED'
-                users[u['id']] = {'name': name, 'length': len(name)}
-            else:
-                name = u['first_name'] + ' ' + u['last_name']
-                users[u['id']] = {'name': name, 'length': len(name)}
-        elif pid < 0:
-            # Group: {..., name, pid, ...} ->
-            #        {-%pid%: {name: 'name', length: len(name) }
-            g = vk.groups.getById(group_id=-pid)[0]
-            name = g['name']
-            users[-g['id']] = {'name': name, 'length': len(name)}
-    except AttributeError:
-        if not kwargs.get('throw'):
-            users_add(vk, pid, throw=True)
-        else:
-            users[pid] = {'name': r'{unknown user}', 'length': 14}
-    except Exception:
-        users[pid] = {'name': r'{unknown user}', 'length': 14}
-
-
-def dump_attachments_only(dmp):
-    """Вложения диалогов
+    Saves attachments of dialog
 
     dmp: Dumper object
+    con: conversation object
+    folder: folder of dialogs
+    out: print-like function for console output
+    files: DialogFiles index of folder
     """
-    global users
-
-    folder = os.path.join('dump', 'dialogs')
-    os.makedirs(folder, exist_ok=True)
+    users = dmp._profiles
+    files = files or DialogFiles(folder)
 
-    print('[получение диалогов...]')
-    print('\x1b[2K  0/???', end='\r')
-
-    conversations = dmp._vk_tools.get_all(
-        method='messages.getConversations',
-        max_count=200,
-        values={
-            'extended': 1,
-            'fields': 'first_name, last_name, name'
-        })
+    did = con['conversation']['peer']['id']
 
-    print('\x1b[2K  {}/{}'.format(len(conversations['items']), conversations['count']))
+    pass_dialog = False
     if dmp._DUMP_DIALOGS_ONLY:
-        print('[будет сохранено диалогов: {}]'.format(len(dmp._DUMP_DIALOGS_ONLY)), end='\n\n')
-    else:
-        print('[будет исключено диалогов: {}]'.format(len(dmp._EXCLUDED_DIALOGS)), end='\n\n')
-
-    print('Сохранение диалогов:')
-    for con in conversations['items']:
-        did = con['conversation']['peer']['id']
-
-        pass_dialog = False
-        if dmp._DUMP_DIALOGS_ONLY:
-            if did not in dmp._DUMP_DIALOGS_ONLY:
-                if dmp._settings['HIDE_EXCLUDED_DIALOGS']:
-                    continue
-            else:
-                pass_dialog = True
-        elif did in dmp._EXCLUDED_DIALOGS:
+        if did not in dmp._DUMP_DIALOGS_ONLY:
             if dmp._settings['HIDE_EXCLUDED_DIALOGS']:
-                continue
-            else:
-                pass_dialog = True
-
-        if con['conversation']['peer']['type'] == 'user':
-            if did not in users:
-                users_add(dmp._vk, did)
-            dialog_name = users.get(did)['name']
-        elif con['conversation']['peer']['type'] == 'group':
-            if did not in users:
-                users_add(dmp._vk, did)
-            dialog_name = users.get(did)['name']
-        elif con['conversation']['peer']['type'] == 'chat':
-            dialog_name = con['conversation']['chat_settings']['title']
+                return
         else:
-            dialog_name = r'{unknown}'
-
-        for c in dmp._INVALID_CHARS:
-            if c in dialog_name:
-                dialog_name = dialog_name.replace(c, dmp._settings['REPLACE_CHAR'])
-
-        fn = '{}_{id}'.format('_'.join(dialog_name.split(' ')), id=did)
-        for n in os.listdir(folder):
-            if str(did) == n.split('.txt')[0].split('_')[-1]:
-                if dmp._settings['KEEP_DIALOG_NAMES']:
-                    fn = n.split('.txt')[0]
-                else:
-                    shutil.move(os.path.join(folder, n),
-                                os.path.join(folder, '{}_{id}'.format('_'.join(dialog_name.split(' ')), id=did) + ('.txt' if '.txt' in n else '')))
-
-        print('  Диалог: {}{nfn}'.format(dialog_name, nfn=(' (as {})'.format(fn) if ' '.join(fn.split('_')[:-1]) != dialog_name else '')))
-        if pass_dialog is True:
-            print('    [исключён]\n')
-            continue
-
-        at_folder = os.path.join(folder, fn)
-        os.makedirs(at_folder, exist_ok=True)
-
-        # PHOTO DUMP
-        print('    [получение фото]', end='\r')
-        photo = get_attachments(dmp._vk, did, 'photo')
-
-        if photo['count'] > 0:
-            af = os.path.join(at_folder, 'Фото')
-            os.makedirs(af, exist_ok=True)
-
-            print('\x1b[2K    [сохранение фото]')
-            print('      .../{}'.format(photo['count']), end='\r')
-
-            with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-                res = pool.starmap(dmp._download,
-                                   zip(itertools.repeat(dmp.__class__),
-                                       map(lambda t: sorted(t['attachment']['photo']['sizes'], key=itemgetter('width', 'height'))[-1]['url'], photo['items']),
-                                       itertools.repeat(af)))
-
-            print('\x1b[2K      {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                          len(photo['items']),
-                                                          len(next(os.walk(af))[2])))
-            del res
+            pass_dialog = True
+    elif did in dmp._EXCLUDED_DIALOGS:
+        if dmp._settings['HIDE_EXCLUDED_DIALOGS']:
+            return
         else:
-            print('    [фото отсутствуют]')
-        del photo
-
-        # VIDEO DUMP
-        print('    [получение видео]', end='\r')
-        video = get_attachments(dmp._vk, did, 'video')
-
-        if video['count'] > 0:
-            video_ids = []
-            for v in video['items']:
-                video_ids.append('{oid}_{id}{access_key}'.format(
-                    oid=v['attachment']['video']['owner_id'],
-                    id=v['attachment']['video']['id'],
-                    access_key=('_'+v['attachment']['video']['access_key'] if 'access_key' in v['attachment']['video'] else '')
-                ))
+            pass_dialog = True
+
+    if con['conversation']['peer']['type'] == 'user':
+        dialog_name = users.get(did)['name']
+    elif con['conversation']['peer']['type'] == 'group':
+        dialog_name = users.get(did)['name']
+    elif con['conversation']['peer']['type'] == 'chat':
+        dialog_name = con['conversation']['chat_settings']['title']
+    else:
+        dialog_name = r'{unknown}'
+
+    for c in dmp._INVALID_CHARS:
+        if c in dialog_name:
+            dialog_name = dialog_name.replace(c, dmp._settings['REPLACE_CHAR'])
+
+    fn = files.resolve(dmp, did, dialog_name)
+
+    out('  Диалог: {}{nfn}'.format(dialog_name, nfn=(' (as {})'.format(fn) if ' '.join(fn.split('_')[:-1]) != dialog_name else '')))
+    if pass_dialog is True:
+        out('    [исключён]\n')
+        return
+
+    at_folder = os.path.join(folder, fn)
+    os.makedirs(at_folder, exist_ok=True)
+
+    # only attachments newer than saved cursors are fetched,
+    # cursor is moved when all of them are downloaded
+    cursors = load_state(folder, did).get('attachments', {})
+
+    # PHOTO DUMP
+    out('    [получение фото]', end='\r')
+    with stage(dmp, 'history/photo'):
+        photo = get_attachments(dmp._vk, did, 'photo', cursors.get('photo', 0))
+
+    if photo['count'] > 0:
+        af = os.path.join(at_folder, 'Фото')
+        os.makedirs(af, exist_ok=True)
+
+        out('\x1b[2K    [сохранение фото]')
+        out('      .../{}'.format(photo['count']), end='\r')
+
+        with stage(dmp, 'attachments/photo'):
+            res = dmp._map(dmp._download,
+                           map(lambda t: {'url': sorted(t['attachment']['photo']['sizes'],
+                                                        key=itemgetter('width', 'height'))[-1]['url'],
+                                          'key': 'photo{}_{}'.format(t['attachment']['photo']['owner_id'],
+                                                                     t['attachment']['photo']['id'])},
+                               photo['items']),
+                           af)
+
+            ok = sum(filter(None, res))
+        out('\x1b[2K      {}/{} (total: {})'.format(ok,
+                                                    len(photo['items']),
+                                                    len(next(os.walk(af))[2])))
+        if ok == len(photo['items']):
+            cursors['photo'] = photo['items'][0]['message_id']
+        del res
+    else:
+        out('    [новые фото отсутствуют]' if 'photo' in cursors else '    [фото отсутствуют]')
+    del photo
+
+    # VIDEO DUMP
+    out('    [получение видео]', end='\r')
+    with stage(dmp, 'history/video'):
+        video = get_attachments(dmp._vk, did, 'video', cursors.get('video', 0))
+
+    if video['count'] > 0:
+        newest = video['items'][0]['message_id']
+        video_ids = []
+        for v in video['items']:
+            video_ids.append('{oid}_{id}{access_key}'.format(
+                oid=v['attachment']['video']['owner_id'],
+                id=v['attachment']['video']['id'],
+                access_key=('_'+v['attachment']['video']['access_key'] if 'access_key' in v['attachment']['video'] else '')
+            ))
+        with stage(dmp, 'history/video'):
             video = dmp._vk_tools.get_all(
                 method='video.get',
                 max_count=200,
@@ -176,55 +119,89 @@ def dump_attachments_only(dmp):
                 }
             )
 
-            af = os.path.join(at_folder, 'Видео')
-            os.makedirs(af, exist_ok=True)
-
-            print('\x1b[2K    [сохранение видео]')
-            print('      .../{}'.format(video['count']), end='\r')
-
-            try:
-                with Pool(dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else dmp._settings['POOL_PROCESSES']) as pool:
-                    res = pool.starmap(dmp._download_video,
-                                       zip(itertools.repeat(dmp.__class__),
-                                           video['items'],
-                                           itertools.repeat(af)))
-                    print('\x1b[2K      {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                                  len(video['items']),
-                                                                  len(next(os.walk(af))[2])))
-                    del res
-            except MaybeEncodingError:
-                print('\x1b[2K      ???/{} (total: {})'.format(len(video['items']), len(next(os.walk(af))[2])))
+        af = os.path.join(at_folder, 'Видео')
+        os.makedirs(af, exist_ok=True)
+
+        out('\x1b[2K    [сохранение видео]')
+        out('      .../{}'.format(video['count']), end='\r')
+
+        try:
+            with stage(dmp, 'attachments/video'):
+                res = dmp._map(dmp._download_video, video['items'], af,
+                               limit=dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else None)
+                ok = sum(filter(None, res))
+            out('\x1b[2K      {}/{} (total: {})'.format(ok,
+                                                        len(video['items']),
+                                                        len(next(os.walk(af))[2])))
+            if ok == len(video['items']):
+                cursors['video'] = newest
+            del res
+        except MaybeEncodingError:
+            out('\x1b[2K      ???/{} (total: {})'.format(len(video['items']), len(next(os.walk(af))[2])))
 
-        else:
-            print('    [видео отсутствуют]')
-        del video
+    else:
+        out('    [новые видео отсутствуют]' if 'video' in cursors else '    [видео отсутствуют]')
+    del video
+
+    # DOCS DUMP
+    out('    [получение документов]', end='\r')
+    with stage(dmp, 'history/doc'):
+        docs = get_attachments(dmp._vk, did, 'doc', cursors.get('doc', 0))
+
+    if docs['count'] > 0:
+        af = os.path.join(at_folder, 'Документы')
+        os.makedirs(af, exist_ok=True)
+
+        out('\x1b[2K    [сохранение документов]')
+        out('      .../{}'.format(docs['count']), end='\r')
+
+        with stage(dmp, 'attachments/doc'):
+            res = dmp._map(dmp._download_doc,
+                           map(lambda t: t['attachment']['doc'], docs['items']),
+                           af)
+
+            ok = sum(filter(None, res))
+        out('\x1b[2K      {}/{} (total: {})'.format(ok,
+                                                    len(docs['items']),
+                                                    len(next(os.walk(af))[2])))
+        if ok == len(docs['items']):
+            cursors['doc'] = docs['items'][0]['message_id']
+        del res
+    else:
+        out('    [новые документы отсутствуют]' if 'doc' in cursors else '    [документы отсутствуют]')
+    del docs
 
-        # DOCS DUMP
-        print('    [получение документов]', end='\r')
-        docs = get_attachments(dmp._vk, did, 'doc')
+    update_state(folder, did, attachments=cursors)
 
-        if docs['count'] > 0:
-            af = os.path.join(at_folder, 'Документы')
-            os.makedirs(af, exist_ok=True)
+    out()
 
-            print('\x1b[2K    [сохранение документов]')
-            print('      .../{}'.format(docs['count']), end='\r')
 
-            with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-                res = pool.starmap(dmp._download_doc,
-                                   zip(itertools.repeat(dmp.__class__),
-                                       map(lambda t: t['attachment']['doc'], docs['items']),
-                                       itertools.repeat(af)))
+def dump_attachments_only(dmp):
+    """Вложения диалогов
 
-            print('\x1b[2K      {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                          len(docs['items']),
-                                                          len(next(os.walk(af))[2])))
-            del res
-        else:
-            print('    [документы отсутствуют]')
-        del docs
+    dmp: Dumper object
+    """
+    users = dmp._profiles
 
-        print()
+    folder = os.path.join('dump', 'dialogs')
+    os.makedirs(folder, exist_ok=True)
 
-    with open('users.json', 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=4)
+    print('[получение диалогов...]')
+    print('\x1b[2K  0/???', end='\r')
+
+    with stage(dmp, 'listing'):
+        conversations = get_conversations(dmp._vk)
+        users.harvest(conversations)
+        users.resolve(dmp._vk, [con['conversation']['peer']['id'] for con in conversations['items']
+                               if con['conversation']['peer']['type'] in ('user', 'group')])
+
+    print('\x1b[2K  {}/{}'.format(len(conversations['items']), conversations['count']))
+    if dmp._DUMP_DIALOGS_ONLY:
+        print('[будет сохранено диалогов: {}]'.format(len(dmp._DUMP_DIALOGS_ONLY)), end='\n\n')
+    else:
+        print('[будет исключено диалогов: {}]'.format(len(dmp._EXCLUDED_DIALOGS)), end='\n\n')
+
+    print('Сохранение диалогов:')
+    files = DialogFiles(folder)
+    save_dialogs(dmp, conversations['items'],
+                 lambda con, out: attachments_handler(dmp, con, folder, out, files))
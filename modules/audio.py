@@ -1,10 +1,10 @@
 import os
 import os.path
-import itertools
-from multiprocess import Pool
 
 import vk_api.audio
 
+from modules.sync_index import SyncIndex, sync_collection
+
 
 def dump_audio(dmp):
     """Аудио
@@ -19,26 +19,23 @@ def dump_audio(dmp):
 
     print('Сохранение аудио:')
 
-    if len(tracks) == 0:
-        print('  0/0 (total: {})'.format(len(next(os.walk(folder))[2])))
-    else:
-        audios = []
-        for a in tracks:
-            audios.append({
-                'url': a['url'],
-                'name': '{artist} - {title}_{id}'.format(artist=a['artist'],
-                                                         title=a['title'],
-                                                         id=a['id']),
-                'ext': 'mp3'
-            })
-
-        print('  .../{}'.format(len(tracks)), end='\r')
-        with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-            res = pool.starmap(dmp._download,
-                               zip(itertools.repeat(dmp.__class__),
-                                   audios,
-                                   itertools.repeat(folder)))
-
-        print('\x1b[2K  {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                  len(audios),
-                                                  len(next(os.walk(folder))[2])))
+    # only new tracks are downloaded
+    index = SyncIndex(os.path.join('dump', '.sync', 'audio.json'))
+
+    audios = {}
+    for a in tracks:
+        audios['{}_{}'.format(a['owner_id'], a['id'])] = {
+            'url': a['url'],
+            'name': '{artist} - {title}_{id}'.format(artist=a['artist'],
+                                                     title=a['title'],
+                                                     id=a['id']),
+            'ext': 'mp3',
+            'key': 'audio{}_{}'.format(a['owner_id'], a['id'])
+        }
+
+    print('  .../{}'.format(len(tracks)), end='\r')
+    ok, n, removed = sync_collection(dmp, index, 'audio', folder, dmp._download, audios)
+
+    print('\x1b[2K  {}/{} (total: {}){}'.format(ok, n,
+                                              len(next(os.walk(folder))[2]),
+                                              f' [удалено: {removed}]' if removed else ''))
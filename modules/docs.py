@@ -1,7 +1,8 @@
 import os
 import os.path
-import itertools
-from multiprocess import Pool
+
+from modules.profiling import stage
+from modules.sync_index import SyncIndex, sync_collection
 
 
 def dump_docs(dmp):
@@ -14,28 +15,26 @@ def dump_docs(dmp):
 
     print('[получение списка документов]')
 
-    docs = dmp._vk.docs.get()
+    with stage(dmp, 'listing'):
+        docs = dmp._vk.docs.get()
 
     print('Сохраненние документов:')
 
-    if docs['count'] == 0:
-        print('    0/0 (total: {})'.format(len(next(os.walk(folder))[2])))
-    else:
-        objs = []
-        for d in docs['items']:
-            objs.append({
-                'url': d['url'],
-                'name': d['title'] + '_' + str(d['id']),
-                'ext': d['ext']
-            })
-
-        print('  .../{}'.format(docs['count']), end='\r')
-        with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-            res = pool.starmap(dmp._download,
-                               zip(itertools.repeat(dmp.__class__),
-                                   objs,
-                                   itertools.repeat(folder)))
-
-        print('\x1b[2K    {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                    len(objs),
-                                                    len(next(os.walk(folder))[2])))
+    # only new documents are downloaded
+    index = SyncIndex(os.path.join('dump', '.sync', 'docs.json'))
+
+    objs = {}
+    for d in docs['items']:
+        objs['{}_{}'.format(d['owner_id'], d['id'])] = {
+            'url': d['url'],
+            'name': d['title'] + '_' + str(d['id']),
+            'ext': d['ext'],
+            'key': 'doc{}_{}'.format(d['owner_id'], d['id'])
+        }
+
+    print('  .../{}'.format(docs['count']), end='\r')
+    ok, n, removed = sync_collection(dmp, index, 'docs', folder, dmp._download, objs)
+
+    print('\x1b[2K    {}/{} (total: {}){}'.format(ok, n,
+                                                len(next(os.walk(folder))[2]),
+                                                f' [удалено: {removed}]' if removed else ''))
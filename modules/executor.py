@@ -0,0 +1,261 @@
+import os
+import asyncio
+import threading
+from types import SimpleNamespace
+from concurrent.futures import Future, as_completed
+
+from multiprocess import Array, Pool
+from multiprocess.pool import MaybeEncodingError
+
+from modules._download import aiohttp, _init_worker, _adownload, _adownload_doc, _adownload_video
+
+# download functions which can be run by asyncio engine
+ASYNC = {
+    '_download': _adownload,
+    '_download_doc': _adownload_doc,
+    '_download_video': _adownload_video
+}
+
+
+def worker_dmp(dmp):
+    """
+    Returns settings of Dumper used by download functions
+
+    Dumper class is defined in __main__ and is pickled by value
+    (~50 KB) with every task, the snapshot is much cheaper
+
+    dmp: Dumper class
+    """
+    return SimpleNamespace(_settings=dict(dmp._settings), _INVALID_CHARS=list(dmp._INVALID_CHARS))
+
+
+class Executor:
+    """
+    Download executor shared by all dump functions
+
+    Engines:
+        process - pool of worker processes
+        async - asyncio event loop in background thread,
+                functions without async version are run in process pool
+
+    Pool and loop are created on first submit and live until close().
+    At most 2*processes (or connections for async) tasks are queued
+    at once, so memory usage doesn't depend on the number of items.
+
+    dmp: Dumper class (passed to download functions)
+    processes: number of worker processes
+    engine: process/async
+    connections: max number of simultaneous async transfers
+    """
+    def __init__(self, dmp, processes, engine='process', connections=256):
+        if engine == 'async' and aiohttp is None:
+            print('[aiohttp не установлен, будет использован пул процессов]')
+            engine = 'process'
+
+        self._dmp = dmp
+        self.processes = processes
+        self.engine = engine
+        self.connections = connections
+        self._pool = None
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._window = threading.BoundedSemaphore(connections if engine == 'async' else 2*processes)
+        self._limits = {}
+        self._lock = threading.Lock()
+        self._stats = Array('q', 2)  # [requests, new connections]
+
+    @property
+    def stats(self):
+        """
+        HTTP statistics: {requests: int, connections: int},
+            where connections - number of new (not reused) connections
+        """
+        return {'requests': self._stats[0], 'connections': self._stats[1]}
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(self.processes, initializer=_init_worker, initargs=(self._stats,))
+            return self._pool
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+                self._thread.start()
+                self._session = asyncio.run_coroutine_threadsafe(self._new_session(), self._loop).result()
+            return self._loop
+
+    async def _new_session(self):
+        async def on_request(session, ctx, params):
+            with self._stats.get_lock():
+                self._stats[0] += 1
+
+        async def on_connection(session, ctx, params):
+            with self._stats.get_lock():
+                self._stats[1] += 1
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_request)
+        trace.on_connection_create_end.append(on_connection)
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections,
+                                           limit_per_host=self._dmp._settings['HTTP_POOL_PER_HOST']),
+            trace_configs=[trace])
+
+    def _limit(self, limit):
+        with self._lock:
+            if limit not in self._limits:
+                self._limits[limit] = threading.BoundedSemaphore(limit)
+            return self._limits[limit]
+
+    def submit(self, fn, obj, folder, limit=None):
+        """
+        Submits fn(dmp, obj, folder), blocks while the queue is full
+
+        Returns concurrent.futures.Future
+
+        limit: max number of simultaneously running tasks with the same limit
+        """
+        sems = [self._limit(limit)] if limit else []
+        sems.append(self._window)
+        for s in sems:
+            s.acquire()
+
+        def release(_):
+            for s in sems:
+                s.release()
+
+        if self.engine == 'async' and fn.__name__ in ASYNC:
+            loop = self._get_loop()
+            fut = asyncio.run_coroutine_threadsafe(
+                ASYNC[fn.__name__](self._session, self._dmp, obj, folder), loop)
+            fut.add_done_callback(release)
+        else:
+            fut = Future()
+            fut.add_done_callback(release)
+            self._get_pool().apply_async(fn, (worker_dmp(self._dmp), obj, folder),
+                                         callback=fut.set_result,
+                                         error_callback=fut.set_exception)
+        return fut
+
+    def map(self, fn, items, folder, limit=None):
+        """
+        Yields results of fn(dmp, item, folder) for each item
+        in order of completion
+
+        items: iterable, consumed lazily
+        """
+        pending = set()
+        for item in items:
+            pending.add(self.submit(fn, item, folder, limit))
+            done = {f for f in pending if f.done()}
+            pending -= done
+            for f in done:
+                yield f.result()
+        for f in as_completed(pending):
+            yield f.result()
+
+    def close(self):
+        with self._lock:
+            if self._loop is not None:
+                asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = None
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+class Downloads:
+    """
+    Downloads submitted to shared executor as soon as they are found,
+    grouped by type (photos, docs, ...)
+
+    dmp: Dumper object
+    on_done: function(group, obj, folder, result, key) called for finished
+             downloads, result is None if task failed, key is given to add()
+    """
+    def __init__(self, dmp, on_done=None):
+        self._dmp = dmp
+        self._on_done = on_done
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+
+    def __contains__(self, group):
+        return group in self._groups
+
+    def _group(self, group, folder):
+        g = self._groups.get(group)
+        if g is None:
+            os.makedirs(folder, exist_ok=True)
+            g = self._groups[group] = {'count': 0, 'ok': 0, 'pending': set(), 'errors': []}
+        return g
+
+    def add(self, group, fn, obj, folder, limit=None, key=None):
+        """
+        Submits fn(dmp, obj, folder), folder is created on first add
+
+        group: name of group
+        limit: max number of simultaneously running tasks
+        key: identity of obj passed to on_done (obj may be a copy
+             if it was sent to worker process)
+        """
+        with self._lock:
+            g = self._group(group, folder)
+            g['count'] += 1
+
+        fut = self._dmp._submit(fn, obj, folder, limit)
+        with self._lock:
+            g['pending'].add(fut)
+
+        def done(fut):
+            # download is pending until on_done is finished,
+            # so join() returns after all callbacks
+            try:
+                if self._on_done:
+                    self._on_done(group, obj, folder, None if fut.exception() else fut.result(), key)
+            finally:
+                with self._finished:
+                    g['pending'].discard(fut)
+                    if fut.exception():
+                        g['errors'].append(fut.exception())
+                    elif fut.result():
+                        g['ok'] += 1
+                    self._finished.notify_all()
+        fut.add_done_callback(done)
+
+    def skip(self, group, folder):
+        """
+        Counts download completed by previous run as succeeded
+        """
+        with self._lock:
+            g = self._group(group, folder)
+            g['count'] += 1
+            g['ok'] += 1
+
+    def count(self, group):
+        """Returns number of submitted downloads"""
+        return self._groups[group]['count']
+
+    def join(self, group):
+        """
+        Waits for all downloads of group, returns (succeeded, total)
+
+        Failed tasks are counted as unsuccessful,
+        errors other than MaybeEncodingError are raised
+        """
+        g = self._groups[group]
+        with self._finished:
+            self._finished.wait_for(lambda: not g['pending'])
+
+        for e in g['errors']:
+            if not isinstance(e, MaybeEncodingError):
+                raise e
+        return g['ok'], g['count']
@@ -1,11 +1,10 @@
 import os
 import os.path
 import inspect
-import itertools
-from multiprocess import Pool
 from multiprocess.pool import MaybeEncodingError
 from operator import itemgetter
 
+from modules.profiling import stage
 from modules.utils import get_fave
 
 
@@ -25,7 +24,7 @@ def dump_menu_fave(dmp):
                                                      '0': {'name': 'В меню', 'action': None}})
         if fun:
             if fun.__name__.startswith('dump_fave_'):
-                fun(dmp)
+                dmp._run(fun)
                 print('\n{clr}Сохранение завершено :з{nc}'.format(
                       clr=dmp._interface._colors['green'],
                       nc=dmp._interface._mods['nc']))
@@ -57,7 +56,8 @@ def dump_fave_posts(dmp):
 
     print('[получение постов]')
 
-    posts = get_fave(dmp._vk, 'posts')
+    with stage(dmp, 'listing'):
+        posts = get_fave(dmp._vk, 'posts')
 
     # from pprint import pprint
     # print(type(posts))
@@ -74,7 +74,8 @@ def dump_fave_posts(dmp):
                     at['photo']['sizes'].sort(key=itemgetter('width', 'height'))
                     obj = {
                         'url': at['photo']['sizes'][-1]['url'],
-                        'prefix': '{}_{}'.format(p['owner_id'], p['id'])
+                        'prefix': '{}_{}'.format(p['owner_id'], p['id']),
+                        'key': 'photo{}_{}'.format(at['photo']['owner_id'], at['photo']['id'])
                     }
                     if 'access_key' in at['photo']:
                         obj['access_key'] = at['photo']['access_key']
@@ -90,51 +91,48 @@ def dump_fave_posts(dmp):
                         'url': at['doc']['url'],
                         'prefix': '{}_{}'.format(p['owner_id'], p['id']),
                         'name': '{}_{}'.format(at['doc']['title'], at['doc']['id']),
-                        'ext': at['doc']['ext']
+                        'ext': at['doc']['ext'],
+                        'key': 'doc{}_{}'.format(at['doc']['owner_id'], at['doc']['id'])
                     }
                     if 'access_key' in at['doc']:
                         obj['access_key'] = at['doc']['access_key']
                     docs.append(obj)
 
     if video:
-        video = dmp._vk_tools.get_all(
-            method='video.get',
-            max_count=200,
-            values={
-                'videos': ','.join(video),
-                'extended': 1
-            }
-        )
+        with stage(dmp, 'listing'):
+            video = dmp._vk_tools.get_all(
+                method='video.get',
+                max_count=200,
+                values={
+                    'videos': ','.join(video),
+                    'extended': 1
+                }
+            )
 
     print('Сохранение ({} вложений из {} постов):'.format(
           sum([len(photo), len(video), len(docs)]), len(posts['items'])))
 
     if photo:
         print('  [фото ({})]'.format(len(photo)))
-        with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-            pool.starmap(dmp._download,
-                         zip(itertools.repeat(dmp.__class__),
-                             photo,
-                             itertools.repeat(folder_photo)))
+        with stage(dmp, 'download'):
+            for _ in dmp._map(dmp._download, photo, folder_photo):
+                pass
 
     try:
         if video:
             print('  [видео ({})]'.format(len(video['items'])))
-            with Pool(dmp._settings['POOL_PROCESSES'] if not dmp._settings['LIMIT_VIDEO_PROCESSES'] else dmp._AVAILABLE_THREADS) as pool:
-                pool.starmap(dmp._download_video,
-                             zip(itertools.repeat(dmp.__class__),
-                                 video['items'],
-                                 itertools.repeat(folder_video)))
+            with stage(dmp, 'download'):
+                for _ in dmp._map(dmp._download_video, video['items'], folder_video,
+                                  limit=dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else None):
+                    pass
     except MaybeEncodingError:
         pass
 
     if docs:
         print('  [документы ({})]'.format(len(docs)))
-        with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-            pool.starmap(dmp._download,
-                         zip(itertools.repeat(dmp.__class__),
-                             docs,
-                             itertools.repeat(folder_docs)))
+        with stage(dmp, 'download'):
+            for _ in dmp._map(dmp._download, docs, folder_docs):
+                pass
 
 
 def dump_fave_photo(dmp):
@@ -147,7 +145,8 @@ def dump_fave_photo(dmp):
 
     print('[получение понравившихся фото]')
 
-    photo = get_fave(dmp._vk, 'photos')
+    with stage(dmp, 'listing'):
+        photo = get_fave(dmp._vk, 'photos')
 
     print('Сохранение понравившихся фото:')
 
@@ -155,14 +154,14 @@ def dump_fave_photo(dmp):
         print('  0/0')
     else:
         print('  .../{}'.format(photo['count']), end='\r')
-        with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-            res = pool.starmap(dmp._download,
-                               zip(itertools.repeat(dmp.__class__),
-                                   map(lambda p: sorted(p['sizes'],
-                                       key=itemgetter('width', 'height'))[-1]['url'],
-                                       photo['items']),
-                                   itertools.repeat(folder)))
-        print('\x1b[2K  {}/{} (total: {})'.format(sum(filter(None, res)),
+        with stage(dmp, 'download'):
+            res = dmp._map(dmp._download,
+                           map(lambda p: {'url': sorted(p['sizes'], key=itemgetter('width', 'height'))[-1]['url'],
+                                          'key': 'photo{}_{}'.format(p['owner_id'], p['id'])},
+                               photo['items']),
+                           folder)
+            ok = sum(filter(None, res))
+        print('\x1b[2K  {}/{} (total: {})'.format(ok,
                                                   photo['count'],
                                                   len(next(os.walk(folder))[2])))
 
@@ -176,7 +175,8 @@ def dump_fave_video(dmp):
     os.makedirs(folder, exist_ok=True)
     print('[получение понравившихся видео]')
 
-    video_ids = get_fave(dmp._vk, 'videos')
+    with stage(dmp, 'listing'):
+        video_ids = get_fave(dmp._vk, 'videos')
     video = []
     if video_ids:
         for v in video_ids['items']:
@@ -186,14 +186,15 @@ def dump_fave_video(dmp):
                 access_key='_'+(v.get('access_key') or '')
             ))
     if video:
-        video = dmp._vk_tools.get_all(
-            method='video.get',
-            max_count=200,
-            values={
-                'videos': ','.join(video),
-                'extended': 1
-            }
-        )
+        with stage(dmp, 'listing'):
+            video = dmp._vk_tools.get_all(
+                method='video.get',
+                max_count=200,
+                values={
+                    'videos': ','.join(video),
+                    'extended': 1
+                }
+            )
 
     print('Сохранение понравившихся видео:')
 
@@ -202,12 +203,11 @@ def dump_fave_video(dmp):
     else:
         print('    .../{}'.format(video['count']), end='\r')
         try:
-            with Pool(dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else dmp._settings['POOL_PROCESSES']) as pool:
-                res = pool.starmap(dmp._download_video,
-                                   zip(itertools.repeat(dmp.__class__),
-                                       video['items'],
-                                       itertools.repeat(folder)))
-            print('\x1b[2K    {}/{} (total: {})'.format(sum([1 for i in res if i is True]),
+            with stage(dmp, 'download'):
+                res = dmp._map(dmp._download_video, video['items'], folder,
+                               limit=dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else None)
+                ok = sum([1 for i in res if i is True])
+            print('\x1b[2K    {}/{} (total: {})'.format(ok,
                                                         video['count'],
                                                         len(next(os.walk(folder))[2])))
         except MaybeEncodingError:
@@ -0,0 +1,88 @@
+import os
+import os.path
+import json
+import threading
+
+
+class Manifest:
+    """
+    Persistent list of dialog's attachments
+
+    Attachments are stored as JSON lines {key, url, path, size, status},
+    where key is VK object identity ({type}{owner_id}_{id}) and path
+    is relative to the attachments folder. New entries are appended
+    to the file immediately, later lines override earlier ones,
+    the file is compacted on close.
+
+    path: manifest file
+    """
+    def __init__(self, path):
+        self._path = path
+        self._items = {}
+        self._lines = 0
+        self._file = None
+        self._unfinished = False
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    # broken lines are counted too, so they are removed on close
+                    self._lines += 1
+                    self._unfinished = not line.endswith('\n')
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        # line broken by interrupted run
+                        continue
+                    self._items[item['key']] = item
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
+    def done(self, key):
+        """Returns True if attachment was successfully downloaded"""
+        item = self._items.get(key)
+        return item is not None and item['status'] == 'ok'
+
+    def set(self, key, url=None, path=None, size=None, status='ok'):
+        """
+        Adds or updates attachment
+
+        status: ok/failed
+        """
+        item = {'key': key, 'url': url, 'path': path, 'size': size, 'status': status}
+        line = json.dumps(item, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._items[key] = item
+            if self._file is None:
+                os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+                self._file = open(self._path, 'a', encoding='utf-8', buffering=1)
+                if self._unfinished:
+                    # new entries don't continue line cut by interrupted run
+                    self._file.write('\n')
+                    self._unfinished = False
+            self._file.write(line)
+            self._lines += 1
+
+    def close(self):
+        """Closes the file, rewrites it without overridden entries"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lines > len(self._items):
+                tmp = self._path + '.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    for item in self._items.values():
+                        f.write(json.dumps(item, ensure_ascii=False) + '\n')
+                os.replace(tmp, self._path)
+                self._lines = len(self._items)
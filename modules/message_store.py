@@ -0,0 +1,136 @@
+import os
+import os.path
+import json
+import sqlite3
+import threading
+
+
+class MessageStore:
+    """
+    SQLite database of dumped messages with full-text search
+
+    Messages are stored as (peer_id, id, from_id, date, text,
+    attachments, fwd, reply_id), where attachments - JSON list of
+    "{type}{owner_id}_{id}", fwd - JSON list of forwarded messages
+    {from_id, date, text}. Text is indexed with FTS5 (FTS4 if SQLite
+    is built without it). Rows are written in large transactions.
+
+    path: database file
+    batch: number of messages written in one transaction
+    """
+    def __init__(self, path, batch=5000):
+        self._path = path
+        self._batch = batch
+        self._rows = []
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                         'peer_id INTEGER NOT NULL, id INTEGER NOT NULL, from_id INTEGER, date INTEGER, '
+                         'text TEXT, attachments TEXT, fwd TEXT, reply_id INTEGER, '
+                         'UNIQUE (peer_id, id))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_date ON messages (peer_id, date)')
+        self._create_fts()
+        self._db.commit()
+
+    def _create_fts(self):
+        if self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+            return
+        try:
+            self._db.executescript('''
+                CREATE VIRTUAL TABLE messages_fts USING fts5(text, content='messages', content_rowid='rowid');
+                CREATE TRIGGER messages_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+                END;
+                CREATE TRIGGER messages_ad AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+                END;
+                CREATE TRIGGER messages_au AFTER UPDATE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+                    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+                END;
+            ''')
+        except sqlite3.OperationalError:
+            # no fts5 module
+            self._db.executescript('''
+                CREATE VIRTUAL TABLE messages_fts USING fts4(content='messages', text);
+                CREATE TRIGGER messages_bd BEFORE DELETE ON messages BEGIN
+                    DELETE FROM messages_fts WHERE docid = old.rowid;
+                END;
+                CREATE TRIGGER messages_bu BEFORE UPDATE ON messages BEGIN
+                    DELETE FROM messages_fts WHERE docid = old.rowid;
+                END;
+                CREATE TRIGGER messages_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (docid, text) VALUES (new.rowid, new.text);
+                END;
+                CREATE TRIGGER messages_au AFTER UPDATE ON messages BEGIN
+                    INSERT INTO messages_fts (docid, text) VALUES (new.rowid, new.text);
+                END;
+            ''')
+
+    @staticmethod
+    def _row(peer_id, msg):
+        attachments = []
+        for at in msg.get('attachments') or []:
+            obj = at.get(at['type'])
+            if isinstance(obj, dict) and 'id' in obj:
+                attachments.append('{}{}_{}'.format(at['type'], obj.get('owner_id', ''), obj['id']))
+        fwd = [{'from_id': m.get('from_id'), 'date': m.get('date'), 'text': m.get('text')}
+               for m in msg.get('fwd_messages') or []]
+        return (peer_id, msg['id'], msg['from_id'], msg['date'], msg.get('text'),
+                json.dumps(attachments) if attachments else None,
+                json.dumps(fwd, ensure_ascii=False) if fwd else None,
+                (msg.get('reply_message') or {}).get('id'))
+
+    def add(self, peer_id, messages):
+        """
+        Adds messages of dialog, rows are written when batch is full
+
+        messages: iterable of message objects
+        """
+        with self._lock:
+            self._rows.extend(self._row(peer_id, m) for m in messages)
+            if len(self._rows) >= self._batch:
+                self._flush()
+
+    def _flush(self):
+        if self._rows:
+            with self._db:
+                self._db.executemany(
+                    'INSERT INTO messages (peer_id, id, from_id, date, text, attachments, fwd, reply_id) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (peer_id, id) DO UPDATE SET '
+                    'from_id = excluded.from_id, date = excluded.date, text = excluded.text, '
+                    'attachments = excluded.attachments, fwd = excluded.fwd, reply_id = excluded.reply_id',
+                    self._rows)
+            self._rows.clear()
+
+    def flush(self):
+        """Writes buffered messages"""
+        with self._lock:
+            self._flush()
+
+    def search(self, query, peer_id=None, limit=50):
+        """
+        Returns messages matching full-text query, newest first:
+            [(peer_id, id, from_id, date, text), ...]
+
+        query: FTS query (words, "phrase", prefix*, AND/OR/NOT)
+        peer_id: search in one dialog only
+        """
+        sql = 'SELECT m.peer_id, m.id, m.from_id, m.date, m.text FROM messages_fts ' \
+              'JOIN messages m ON m.rowid = messages_fts.rowid WHERE messages_fts MATCH ?'
+        args = [query]
+        if peer_id is not None:
+            sql += ' AND m.peer_id = ?'
+            args.append(peer_id)
+        sql += ' ORDER BY m.date DESC LIMIT ?'
+        args.append(limit)
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.close()
@@ -3,18 +3,17 @@ import os.path
 import time
 import re
 import json
-import shutil
-import itertools
-from multiprocess import Pool
-from multiprocess.pool import MaybeEncodingError
 from operator import itemgetter
 
-from vk_api.exceptions import VkToolsException
+from vk_api.exceptions import ApiError
 
-users = {}
-if os.path.exists('users.json'):
-    with open('users.json', 'r', encoding='utf-8') as f:
-        users = json.load(f)
+from modules._download import _path
+from modules.executor import Downloads
+from modules.manifest import Manifest
+from modules.message_store import MessageStore
+from modules.profiling import stage, stage_iter
+from modules.state import load_state, update_state, state_path
+from modules.utils import DialogFile, DialogFiles, get_conversations, get_history, save_dialogs, zstandard
 
 
 def time_handler(t):
@@ -32,56 +31,58 @@ def time_handler(t):
     return ' '.join(t).format_map(m)
 
 
-def users_add(vk, pid, **kwargs):
+def users_collect(msg, ids):
     """
-    Gets user's info and add it to users object
+    Collects ids of all profiles mentioned in message
+    (sender, forwarded and reply messages, comments, chat actions)
+
+    msg: message object
+    ids: set to be filled
+    """
+    ids.add(msg['from_id'])
+
+    for fwd in msg.get('fwd_messages') or []:
+        users_collect(fwd, ids)
+
+    if msg.get('reply_message'):
+        users_collect(msg['reply_message'], ids)
+
+    for at in msg.get('attachments') or []:
+        if at['type'] == 'wall_reply':
+            ids.add(at['wall_reply']['from_id'])
+
+    if msg.get('action') and msg['action'].get('member_id', 0) > 0:
+        ids.add(msg['action']['member_id'])
 
-    vk: vk_api
-    pid: profile id
 
-    possible kwargs:
-        throw - don't handle AttributeError exception if it occurs again
+def attachment_key(a):
     """
-    global users
-    try:
-        if pid > 0:
-            # User: {..., first_name, last_name, pid, ...} ->
-            #       {pid:{name: 'first_name + last_name', length: len(name)}
-            u = vk.users.get(user_ids=pid)[0]
-            if (u.get('deactivated') == 'deleted') and (u['first_name'] == 'DELETED'):
-                name = 'DELETED'
-                users[u['id']] = {'name': name, 'length': len(name)}
-            else:
-                name = u['first_name'] + ' ' + u['last_name']
-                users[u['id']] = {'name': name, 'length': len(name)}
-        elif pid < 0:
-            # Group: {..., name, pid, ...} ->
-            #        {-%pid%: {name: 'name', length: len(name) }
-            g = vk.groups.getById(group_id=-pid)[0]
-            name = g['name']
-            users[-g['id']] = {'name': name, 'length': len(name)}
-    except AttributeError:
-        if not kwargs.get('throw'):
-            users_add(vk, pid, throw=True)
-        else:
-            users[pid] = {'name': r'{unknown user}', 'length': 14}
-    except Exception:
-        users[pid] = {'name': r'{unknown user}', 'length': 14}
+    Returns VK object identity of attachment to be downloaded
+
+    a: video id ({owner_id}_{id}[_{access_key}]), video object
+       or download object with "key"
+    """
+    if isinstance(a, str):
+        return 'video' + '_'.join(a.split('_')[:2])
+    elif 'key' in a:
+        return a['key']
+    else:
+        return 'video{}_{}'.format(a['owner_id'], a['id'])
 
 
-def message_handler(dmp, msg, **kwargs):
+class MessageRenderer:
     """
-    Обработчик сообщений.
-    Возвращает объект
-        {
-            "date": str, # [HH:MM]
-            "messages": [...],
-            "attachments": {
-                "photos": [...],
-                "video_ids": [...],
-                "docs": [...]
-            }
-        }
+    Обработчик сообщений, renders them into text of dialog:
+
+            [dd месяц YYYY]
+        [HH:MM] name: line
+                      line
+                      name> quoted line
+
+    Lines are written into buffer as they're produced. Lines of forwarded
+    and reply messages are prefixed by the stack of quote levels: "{name}> "
+    for the first line of level and spaces for the rest.
+    Attachments to be downloaded are collected into `attachments`.
 
     [документация API]
         [вложения]
@@ -89,510 +90,542 @@ def message_handler(dmp, msg, **kwargs):
                 - vk.com/dev/objects/attachments_m
             [wall_reply]
                 - vk.com/dev/objects/attachments_w
-    """
-    global users
 
-    r = {
-        'date': time.strftime('[%H:%M]', time.gmtime(msg['date'])),
-        'messages': [],
-        'attachments': {
+    dmp: Dumper object
+    prev: sender of the last rendered message (appended dialog)
+    prev_date: date of the last rendered message
+    """
+    def __init__(self, dmp, prev=None, prev_date=None):
+        self._users = dmp._profiles
+        self._buf = []
+        self._write = self._buf.append
+        self._dates = {}
+        self._quotes = []
+        self._lead = self._cont = ''
+        self._lines = 0
+        self.prev = prev
+        self.prev_date = prev_date
+        self.attachments = {
             'photos': [],
             'video_ids': [],
             'docs': [],
             'audio_messages': []
         }
-    }
 
-    if msg.get('fwd_messages'):
-        for fwd in msg['fwd_messages']:
-            res = message_handler(dmp, fwd)
+    def render(self, msg):
+        """
+        Renders message with date header
+
+        msg: message object
+        """
+        users = self._users
+        w = self._write
+
+        day = msg['date'] // 86400
+        date = self._dates.get(day)
+        if date is None:
+            date = self._dates[day] = time_handler(msg['date'])
+
+        if self.prev_date != date:
+            if self.prev_date:
+                w('\n')
+            w(f'        [{date}]\n')
+        sec = msg['date'] % 86400
+        w('[{:02d}:{:02d}] '.format(sec // 3600, sec // 60 % 60))
+
+        user = users.get(msg['from_id'])
+        hold = ' ' * (user['length'] + 2)
+        self._lead = hold if (self.prev and date and self.prev == msg['from_id'] and self.prev_date == date) \
+            else user['name'] + ': '
+        self._cont = hold + ' '*8
+        self._lines = 0
+
+        self._message(msg)
+        if not self._lines:
+            w('\n')
+
+        self.prev = msg['from_id']
+        self.prev_date = date
+
+    def _line(self, text):
+        w = self._write
+        w(self._lead if not self._lines else self._cont)
+        self._lines += 1
+        for q in self._quotes:
+            w(q[1] if q[2] else q[0])
+            q[2] = True
+        w(text)
+        w('\n')
+
+    def _quoted(self, msg):
+        name = self._users.get(msg['from_id'])['name']
+        self._quotes.append([name + '> ', ' '*len(name) + '> ', False])
+        self._message(msg)
+        self._quotes.pop()
+
+    def _message(self, msg):
+        users = self._users
+        line = self._line
+        atts = self.attachments
+
+        for fwd in msg.get('fwd_messages') or []:
+            self._quoted(fwd)
+
+        if msg.get('reply_message'):
+            self._quoted(msg['reply_message'])
+
+        if len(msg['text']) > 0:
+            for text in msg['text'].split('\n'):
+                line(text)
+
+        if msg['attachments']:
+            for at in msg['attachments']:
+                tp = at['type']
+
+                if tp == 'photo':
+                    if 'action' not in msg:
+                        at[tp]['sizes'].sort(key=itemgetter('width', 'height'))
+                        line('[фото: {}]'.format(at[tp]['sizes'][-1]['url']))
+                        atts['photos'].append({
+                            'url': at[tp]['sizes'][-1]['url'],
+                            'key': 'photo{}_{}'.format(at[tp]['owner_id'], at[tp]['id'])
+                        })
+                elif tp == 'video':
+                    line('[видео: vk.com/video{oid}_{id}]'.format(
+                        oid=at[tp]['owner_id'], id=at[tp]['id']))
+                    atts['video_ids'].append('{oid}_{id}{access_key}'.format(
+                        oid=at[tp]['owner_id'],
+                        id=at[tp]['id'],
+                        access_key=('_'+at[tp]['access_key'] if 'access_key' in at[tp] else '')
+                    ))
+                elif tp == 'audio':
+                    line('[аудио: {artist} - {title}]'.format(
+                        artist=at[tp]['artist'], title=at[tp]['title']))
+                elif tp == 'doc':
+                    line('[документ: vk.com/doc{oid}_{id}]'.format(
+                        oid=at[tp]['owner_id'], id=at[tp]['id']))
+                    atts['docs'].append({
+                        'url': at[tp]['url'],
+                        'name': at[tp]['title'] + '_' + str(at[tp]['id']),
+                        'ext': at[tp]['ext'],
+                        'key': 'doc{}_{}'.format(at[tp]['owner_id'], at[tp]['id'])
+                    })
+                elif tp == 'link':
+                    line('[ссылка: {title} ({url})]'.format(
+                        title=at[tp]['title'], url=at[tp]['url']))
+                elif tp == 'market':
+                    line('[товар: {title} ({price}{cur}) [vk.com/market?w=product{owid}_{id}]]'.format(
+                        title=at[tp]['title'],
+                        owid=at[tp]['owner_id'],
+                        id=at[tp]['id'],
+                        price=at[tp]['price']['amount'],
+                        cur=at[tp]['price']['currency']['name'].lower()))
+                elif tp == 'market_album':
+                    line('[коллекция товаров: {}]'.format(at[tp]['title']))
+                elif tp == 'wall':
+                    line('[пост: vk.com/wall{oid}_{id}]'.format(
+                        oid=at[tp]['to_id'], id=at[tp]['id']))
+                elif tp == 'wall_reply':
+                    u = users.get(at[tp]['from_id'])
+                    line('[комментарий к посту от {user}: {msg} (vk.com/wall{oid}_{pid}?reply={id})]'.format(
+                        user=u['name'],
+                        msg=at[tp]['text'],
+                        oid=at[tp]['owner_id'],
+                        pid=at[tp]['post_id'],
+                        id=at[tp]['id']))
+                elif tp == 'sticker':
+                    line('[стикер: {}]'.format(at[tp]['images'][-1]['url']))
+                elif tp == 'gift':
+                    line('[подарок: {}]'.format(at[tp]['id']))
+                elif tp == 'graffiti':
+                    line('[граффити: {}]'.format(at[tp]['url']))
+                elif tp == 'audio_message':
+                    line('[голосовое сообщение: {}]'.format(at[tp]['link_mp3']))
+                    atts['audio_messages'].append({
+                        'url': at[tp]['link_mp3'],
+                        'name': '{from_id}_{date}_{id}'.format(
+                            from_id=str(msg['from_id']),
+                            date=time.strftime('%Y_%m_%d', time.gmtime(msg['date'])),
+                            id=str(at[tp]['id'])),
+                        'ext': 'mp3',
+                        'key': 'audio_message{}_{}'.format(at[tp]['owner_id'], at[tp]['id'])})
+                else:
+                    line(f'[вложение с типом "{tp}": {json.dumps(at[tp])}]')
+
+        if msg.get('action'):
+            # member - совершающий действие
+            # user - объект действия
+            act = msg['action']
+            tp = act['type']
+
+            if tp == 'chat_photo_update':
+                msg['attachments'][0]['photo']['sizes'].sort(key=itemgetter('width', 'height'))
+                line('[{member} обновил фотографию беседы ({url})]'.format(
+                    member=users[msg['from_id']]['name'],
+                    url=msg['attachments'][0]['photo']['sizes'][-1]['url']
+                ))
+                atts['photos'].append({
+                    'url': msg['attachments'][0]['photo']['sizes'][-1]['url'],
+                    'key': 'photo{}_{}'.format(msg['attachments'][0]['photo']['owner_id'],
+                                               msg['attachments'][0]['photo']['id'])
+                })
+            elif tp == 'chat_photo_remove':
+                line('[{member} удалил фотографию беседы]'.format(
+                    member=users[msg['from_id']]['name']
+                ))
+            elif tp == 'chat_create':
+                line('[{member} создал чат "{chat_name}"]'.format(
+                    member=users[msg['from_id']]['name'],
+                    chat_name=act['text']
+                ))
+            elif tp == 'chat_title_update':
+                line('[{member} изменил название беседы на «{chat_name}»]'.format(
+                    member=users[msg['from_id']]['name'],
+                    chat_name=act['text']
+                ))
+            elif tp == 'chat_invite_user':
+                line('[{member} пригласил {user}]'.format(
+                    member=users[msg['from_id']]['name'],
+                    user=users[act['member_id']
+                               ]['name'] if act['member_id'] > 0 else act['email'],
+                ))
+            elif tp == 'chat_kick_user':
+                line('[{member} исключил {user}]'.format(
+                    member=users[msg['from_id']]['name'],
+                    user=users[act['member_id']
+                               ]['name'] if act['member_id'] > 0 else act['email'],
+                ))
+            # TODO: полная обработка закреплённого сообщения
+            elif tp == 'chat_pin_message':
+                line('[{member} закрепил сообщение #{id}: "{message}"]'.format(
+                    member=users[msg['from_id']]['name'],
+                    id=act['conversation_message_id'],
+                    message=act['message'] if 'message' in act else ''
+                ))
+            elif tp == 'chat_unpin_message':
+                line('[{member} открепил сообщение]'.format(
+                    member=users[msg['from_id']]['name']
+                ))
+            elif tp == 'chat_invite_user_by_link':
+                line('[{user} присоединился по ссылке]'.format(
+                    user=users[msg['from_id']]['name']
+                ))
 
-            if len(res['messages']) > 0:
-                if fwd['from_id'] not in users:
-                    users_add(dmp._vk, fwd['from_id'])
-                r['messages'].append('{name}> {}'.format(
-                    res['messages'][0], name=users.get(fwd['from_id'])['name']))
-                for m in res['messages'][1:]:
-                    r['messages'].append('{name}> {}'.format(
-                        m, name=' ' * len(users.get(fwd['from_id'])['name'])))
+    def flush(self, f):
+        """
+        Writes rendered text
 
-            for tp in res['attachments']:
-                for a in res['attachments'][tp]:
-                    r['attachments'][tp].append(a)
+        f: file-like object
+        """
+        if self._buf:
+            f.write(''.join(self._buf))
+            self._buf.clear()
 
-    if msg.get('reply_message'):
-        res = message_handler(dmp, msg['reply_message'])
-
-        if len(res['messages']) > 0:
-            if msg['reply_message']['from_id'] not in users:
-                users_add(dmp._vk, msg['reply_message']['from_id'])
-
-            r['messages'].append('{name}> {}'.format(
-                res['messages'][0], name=users.get(msg['reply_message']['from_id'])['name']))
-            for m in res['messages'][1:]:
-                r['messages'].append('{name}> {}'.format(
-                    m, name=' ' * len(users.get(msg['reply_message']['from_id'])['name'])))
-
-        for tp in res['attachments']:
-            for a in res['attachments'][tp]:
-                r['attachments'][tp].append(a)
-
-    if len(msg['text']) > 0:
-        for line in msg['text'].split('\n'):
-            r['messages'].append(line)
-
-    if msg['attachments']:
-        for at in msg['attachments']:
-            tp = at['type']
-
-            if tp == 'photo':
-                if 'action' not in msg:
-                    at[tp]['sizes'].sort(key=itemgetter('width', 'height'))
-                    r['messages'].append('[фото: {}]'.format(at[tp]['sizes'][-1]['url']))
-                    r['attachments']['photos'].append(at[tp]['sizes'][-1]['url'])
-            elif tp == 'video':
-                r['messages'].append('[видео: vk.com/video{oid}_{id}]'.format(
-                    oid=at[tp]['owner_id'], id=at[tp]['id']))
-                r['attachments']['video_ids'].append('{oid}_{id}{access_key}'.format(
-                    oid=at[tp]['owner_id'],
-                    id=at[tp]['id'],
-                    access_key=('_'+at[tp]['access_key'] if 'access_key' in at[tp] else '')
-                ))
-            elif tp == 'audio':
-                r['messages'].append('[аудио: {artist} - {title}]'.format(
-                    artist=at[tp]['artist'], title=at[tp]['title']))
-            elif tp == 'doc':
-                r['messages'].append('[документ: vk.com/doc{oid}_{id}]'.format(
-                    oid=at[tp]['owner_id'], id=at[tp]['id']))
-                r['attachments']['docs'].append({
-                    'url': at[tp]['url'],
-                    'name': at[tp]['title'] + '_' + str(at[tp]['id']),
-                    'ext': at[tp]['ext']
-                })
-            elif tp == 'link':
-                r['messages'].append('[ссылка: {title} ({url})]'.format(
-                    title=at[tp]['title'], url=at[tp]['url']))
-            elif tp == 'market':
-                r['messages'].append('[товар: {title} ({price}{cur}) [vk.com/market?w=product{owid}_{id}]]'.format(
-                    title=at[tp]['title'],
-                    owid=at[tp]['owner_id'],
-                    id=at[tp]['id'],
-                    price=at[tp]['price']['amount'],
-                    cur=at[tp]['price']['currency']['name'].lower()))
-            elif tp == 'market_album':
-                r['messages'].append('[коллекция товаров: {}]'.format(at[tp]['title']))
-            elif tp == 'wall':
-                r['messages'].append('[пост: vk.com/wall{oid}_{id}]'.format(
-                    oid=at[tp]['to_id'], id=at[tp]['id']))
-            elif tp == 'wall_reply':
-                if at[tp]['from_id'] not in users:
-                    users_add(dmp._vk, at[tp]['from_id'])
-                u = users.get(at[tp]['from_id'])
-                r['messages'].append('[комментарий к посту от {user}: {msg} (vk.com/wall{oid}_{pid}?reply={id})]'.format(
-                    user=u['name'],
-                    msg=at[tp]['text'],
-                    oid=at[tp]['owner_id'],
-                    pid=at[tp]['post_id'],
-                    id=at[tp]['id']))
-            elif tp == 'sticker':
-                r['messages'].append('[стикер: {}]'.format(at[tp]['images'][-1]['url']))
-            elif tp == 'gift':
-                r['messages'].append('[подарок: {}]'.format(at[tp]['id']))
-            elif tp == 'graffiti':
-                r['messages'].append('[граффити: {}]'.format(at[tp]['url']))
-            elif tp == 'audio_message':
-                r['messages'].append('[голосовое сообщение: {}]'.format(at[tp]['link_mp3']))
-                r['attachments']['audio_messages'].append({
-                    'url': at[tp]['link_mp3'],
-                    'name': '{from_id}_{date}_{id}'.format(
-                        from_id=str(msg['from_id']),
-                        date=time.strftime('%Y_%m_%d', time.gmtime(msg['date'])),
-                        id=str(at[tp]['id'])),
-                    'ext': 'mp3'})
-            else:
-                r['messages'].append(f'[вложение с типом "{tp}": {json.dumps(at[tp])}]')
-
-    if msg.get('action'):
-        # member - совершающий действие
-        # user - объект действия
-        act = msg['action']
-        tp = act['type']
-
-        if ('member_id' in act) and (act['member_id'] > 0) and (act['member_id'] not in users):
-            try:
-                users_add(dmp._vk, act['member_id'])
-            except Exception:
-                users[act['member_id']] = {'name': '{unknown user}', 'length': 3}
-
-        if tp == 'chat_photo_update':
-            msg['attachments'][0]['photo']['sizes'].sort(key=itemgetter('width', 'height'))
-            r['messages'].append('[{member} обновил фотографию беседы ({url})]'.format(
-                member=users[msg['from_id']]['name'],
-                url=msg['attachments'][0]['photo']['sizes'][-1]['url']
-            ))
-            r['attachments']['photos'].append(msg['attachments'][0]['photo']['sizes'][-1]['url'])
-        elif tp == 'chat_photo_remove':
-            r['messages'].append('[{member} удалил фотографию беседы]'.format(
-                member=users[msg['from_id']]['name']
-            ))
-        elif tp == 'chat_create':
-            r['messages'].append('[{member} создал чат "{chat_name}"]'.format(
-                member=users[msg['from_id']]['name'],
-                chat_name=act['text']
-            ))
-        elif tp == 'chat_title_update':
-            r['messages'].append('[{member} изменил название беседы на «{chat_name}»]'.format(
-                member=users[msg['from_id']]['name'],
-                chat_name=act['text']
-            ))
-        elif tp == 'chat_invite_user':
-            r['messages'].append('[{member} пригласил {user}]'.format(
-                member=users[msg['from_id']]['name'],
-                user=users[act['member_id']
-                           ]['name'] if act['member_id'] > 0 else act['email'],
-            ))
-        elif tp == 'chat_kick_user':
-            r['messages'].append('[{member} исключил {user}]'.format(
-                member=users[msg['from_id']]['name'],
-                user=users[act['member_id']
-                           ]['name'] if act['member_id'] > 0 else act['email'],
-            ))
-        # TODO: полная обработка закреплённого сообщения
-        elif tp == 'chat_pin_message':
-            r['messages'].append('[{member} закрепил сообщение #{id}: "{message}"]'.format(
-                member=users[msg['from_id']]['name'],
-                id=act['conversation_message_id'],
-                message=act['message'] if 'message' in act else ''
-            ))
-        elif tp == 'chat_unpin_message':
-            r['messages'].append('[{member} открепил сообщение]'.format(
-                member=users[msg['from_id']]['name']
-            ))
-        elif tp == 'chat_invite_user_by_link':
-            r['messages'].append('[{user} присоединился по ссылке]'.format(
-                user=users[msg['from_id']]['name']
-            ))
-    return r
 
+def dialog_compression(dmp):
+    """Returns compression of dialog files: '', gzip or zstd (gzip if zstandard isn't installed)"""
+    compression = dmp._settings['DIALOG_COMPRESSION'] or ''
+    if compression == 'zstd' and zstandard is None:
+        compression = 'gzip'
+    return compression if compression in DialogFile.SUFFIXES else ''
 
-def dump_messages(dmp, **kwargs):
-    """Сообщения
 
-    dmp: Dumper object
+def legacy_append(path):
     """
-    global users
+    Finds "[last:N]" marker and last date of dialog file
+    saved without state file
 
-    folder = os.path.join('dump', 'dialogs')
-    os.makedirs(folder, exist_ok=True)
+    Returns {start_message_id, prev_date, offset} or {} if there is no marker
 
-    print('[получение диалогов...]')
-    print('\x1b[2K  0/???', end='\r')
+    path: dialog file
+    """
+    try:
+        with open(path, 'rb') as t:
+            t.seek(-2, 2)
+            while t.read(1) != b'\n':
+                t.seek(-2, 1)
+            last = t.readline().decode()
+
+            r = re.match('^\[last:[0-9]+\]$', last)
+            if not r:
+                return {}
+            res = {'start_message_id': int(re.search(r'\d+', r.group(0)).group(0)),
+                   'offset': t.tell() - len(last.encode('utf-8'))}
+
+            t.seek(-len(last.encode('utf-8'))-2, 1)
+            while True:
+                while t.read(1) != b'\n':
+                    t.seek(-2, 1)
+                tmp = t.readline().decode()
+                r = re.match('^ {8}\[\d+ [а-я a-z]+ \d+\]$', tmp)
+                if r:
+                    res['prev_date'] = re.search('\d+ [а-я a-z]+ \d+', r.group(0)).group(0)
+                    return res
+                else:
+                    t.seek(-len(tmp.encode('utf-8'))-2, 1)
+    except OSError:
+        return {}
 
-    conversations = dmp._vk_tools.get_all(
-        method='messages.getConversations',
-        max_count=200,
-        values={
-            'extended': 1,
-            'fields': 'first_name, last_name, name'
-        })
 
-    print('\x1b[2K  {}/{}'.format(len(conversations['items']), conversations['count']))
-    if dmp._DUMP_DIALOGS_ONLY:
-        print('[будет сохранено диалогов: {}]'.format(len(dmp._DUMP_DIALOGS_ONLY)), end='\n\n')
-    else:
-        print('[будет исключено диалогов: {}]'.format(len(dmp._EXCLUDED_DIALOGS)), end='\n\n')
+def dialog_handler(dmp, con, folder, out=print, files=None, store=None):
+    """
+    Saves dialog and its attachments
 
-    print('Сохранение диалогов:')
-    for con in conversations['items']:
-        did = con['conversation']['peer']['id']
+    dmp: Dumper object
+    con: conversation object
+    folder: folder of dialogs
+    out: print-like function for console output
+    files: DialogFiles index of folder
+    store: MessageStore messages are written to
+    """
+    users = dmp._profiles
+    files = files or DialogFiles(folder)
 
-        pass_dialog = False
-        if dmp._DUMP_DIALOGS_ONLY:
-            if did not in dmp._DUMP_DIALOGS_ONLY:
-                if dmp._settings['HIDE_EXCLUDED_DIALOGS']:
-                    continue
-                else:
-                    pass_dialog = True
-        elif did in dmp._EXCLUDED_DIALOGS:
+    did = con['conversation']['peer']['id']
+
+    pass_dialog = False
+    if dmp._DUMP_DIALOGS_ONLY:
+        if did not in dmp._DUMP_DIALOGS_ONLY:
             if dmp._settings['HIDE_EXCLUDED_DIALOGS']:
-                continue
+                return
             else:
                 pass_dialog = True
-
-        if con['conversation']['peer']['type'] == 'user':
-            if did not in users:
-                users_add(dmp._vk, did)
-            dialog_name = users.get(did)['name']
-        elif con['conversation']['peer']['type'] == 'group':
-            if did not in users:
-                users_add(dmp._vk, did)
-            dialog_name = users.get(did)['name']
-        elif con['conversation']['peer']['type'] == 'chat':
-            dialog_name = con['conversation']['chat_settings']['title']
+    elif did in dmp._EXCLUDED_DIALOGS:
+        if dmp._settings['HIDE_EXCLUDED_DIALOGS']:
+            return
+        else:
+            pass_dialog = True
+
+    if con['conversation']['peer']['type'] == 'user':
+        dialog_name = users.get(did)['name']
+    elif con['conversation']['peer']['type'] == 'group':
+        dialog_name = users.get(did)['name']
+    elif con['conversation']['peer']['type'] == 'chat':
+        dialog_name = con['conversation']['chat_settings']['title']
+    else:
+        dialog_name = r'{unknown}'
+
+    for c in dmp._INVALID_CHARS:
+        if c in dialog_name:
+            dialog_name = dialog_name.replace(c, dmp._settings['REPLACE_CHAR'])
+
+    fn = files.resolve(dmp, did, dialog_name)
+
+    out('  Диалог: {}{nfn}'.format(dialog_name, nfn=(' (as {})'.format(fn) if ' '.join(fn.split('_')[:-1]) != dialog_name else '')))
+    if pass_dialog is True:
+        out('    [исключён]\n')
+        return
+
+    compression = dialog_compression(dmp)
+    orig_file = os.path.join(folder, fn + DialogFile.SUFFIXES[compression])
+    state = load_state(folder, did)
+    # saved offset belongs to a file with other compression
+    if state.get('compression', '') != compression:
+        state = {}
+
+    # nothing new since the last run: history and attachments aren't requested
+    if dmp._settings['SKIP_UNCHANGED_DIALOGS'] and con['conversation'].get('last_message_id') and \
+            state.get('last_id') == con['conversation']['last_message_id'] and os.path.exists(orig_file) and \
+            (store is None or state.get('stored')):
+        out('    [без изменений]\n')
+        return
+
+    # new messages are appended in place of "[last:N]" marker,
+    # its position is saved in sidecar state file
+    append = {'use': dmp._settings['DIALOG_APPEND_MESSAGES'] and os.path.exists(orig_file)}
+    # messages appended before MESSAGES_DB was enabled aren't in the database,
+    # the whole history is saved once
+    if store is not None and not state.get('stored'):
+        append['use'] = False
+    if append['use']:
+        if state.get('offset') is not None and os.path.getsize(orig_file) >= state['offset']:
+            append.update(start_message_id=state['last_id'], prev_date=state['last_date'],
+                          prev=state['last_from_id'], offset=state['offset'])
+        elif compression:
+            # marker can't be found without decompressing the whole file
+            append['use'] = False
         else:
-            dialog_name = r'{unknown}'
+            append.update(legacy_append(orig_file))
+            append['use'] = 'offset' in append
+
+    # completed downloads are remembered and skipped on next runs
+    manifest = Manifest(state_path(folder, did, 'manifest'))
+
+    def on_done(tp, a, at_folder, result, key):
+        if not result:
+            manifest.set(key, status='failed')
+            return
+        url = a['url'] if tp != 'video_ids' else None
+        path = _path(dmp, dmp._download_video if tp == 'video_ids' else dmp._download, a, at_folder)
+        size = os.path.getsize(path) if path and os.path.exists(path) else None
+        manifest.set(key, url=url, size=size,
+                     path=os.path.relpath(path, os.path.join(at_folder, '..')) if path else None)
+
+    # attachments are downloaded while history is being saved
+    downloads = Downloads(dmp, on_done=on_done)
+    folders = {
+        'photos': 'Фото',
+        'video_ids': 'Видео',
+        'docs': 'Документы',
+        'audio_messages': 'Голосовые'
+    }
+    seen = {tp: set() for tp in folders}
+    video_ids = []
 
-        for c in dmp._INVALID_CHARS:
-            if c in dialog_name:
-                dialog_name = dialog_name.replace(c, dmp._settings['REPLACE_CHAR'])
+    def add_videos():
+        try:
+            videos = dmp._vk.video.get(videos=','.join(video_ids), count=200, extended=1)
+        except ApiError as e:
+            # videos aren't in manifest and will be requested next time
+            out('\x1b[2K    [не удалось получить видео ({}): {}]'.format(len(video_ids), e))
+            videos = {'items': []}
+        for v in videos['items']:
+            downloads.add('video_ids', dmp._download_video, v, os.path.join(folder, fn, folders['video_ids']),
+                          limit=dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else None,
+                          key=attachment_key(v))
+        video_ids.clear()
+
+    def history():
+        try:
+            yield from get_history(dmp._vk, did, append.get('start_message_id'))
+        except ApiError:
+            # already written messages are kept, the rest will be appended next time
+            pass
 
-        fn = '{}_{id}'.format('_'.join(dialog_name.split(' ')), id=did)
-        for n in os.listdir(folder):
-            if str(did) == n.split('.txt')[0].split('_')[-1]:
-                if dmp._settings['KEEP_DIALOG_NAMES']:
-                    fn = n.split('.txt')[0]
-                else:
-                    shutil.move(os.path.join(folder, n),
-                                os.path.join(folder, '{}_{id}'.format('_'.join(dialog_name.split(' ')), id=did) + ('.txt' if '.txt' in n else '')))
-
-        print('  Диалог: {}{nfn}'.format(dialog_name, nfn=(' (as {})'.format(fn) if ' '.join(fn.split('_')[:-1]) != dialog_name else '')))
-        if pass_dialog is True:
-            print('    [исключён]\n')
-            continue
-
-        values = {
-            'peer_id': con['conversation']['peer']['id'],
-            'extended': 1,
-            'fields': 'first_name, last_name'
-        }
+    # history is fetched, rendered and written page by page,
+    # file is opened on the first received page
+    f = None
+    count = 0
+    last_id = None
+    renderer = MessageRenderer(dmp, prev=append.get('prev'), prev_date=append.get('prev_date'))
 
-        append = {'use': dmp._settings['DIALOG_APPEND_MESSAGES'] and
-                  os.path.exists(os.path.join(folder, f'{fn}.txt'))}
-        try:
-            if append['use']:
-                with open(os.path.join(folder, f'{fn}.txt'), 'rb') as t:
-                    t.seek(-2, 2)
-                    while t.read(1) != b'\n':
-                        t.seek(-2, 1)
-                    last = t.readline().decode()
-
-                    r = re.match('^\[last:[0-9]+\]$', last)
-                    if r:
-                        start_message_id = int(re.search(r'\d+', r.group(0)).group(0))
-                        values['start_message_id'] = start_message_id
-
-                        t.seek(-len(last.encode('utf-8'))-2, 1)
-                        while True:
-                            while t.read(1) != b'\n':
-                                t.seek(-2, 1)
-                            tmp = t.readline().decode()
-                            r = re.match('^ {8}\[\d+ [а-я a-z]+ \d+\]$', tmp)
-                            # TODO: получение last_id по последнему сообщению (???)
-                            if r:
-                                append['prev_date'] = re.search('\d+ [а-я a-z]+ \d+', r.group(0)).group(0)
-                                break
-                            else:
-                                t.seek(-len(tmp.encode('utf-8'))-2, 1)
+    out('    [сохранение сообщений]')
+    out('\x1b[2K      0/???', end='\r')
+
+    try:
+        for page in stage_iter(dmp, 'history', history()):
+            users.harvest(page)
+            ids = set()
+            for m in page['items']:
+                users_collect(m, ids)
+            users.resolve(dmp._vk, ids)
+            if store is not None:
+                store.add(did, page['items'])
+
+            if f is None:
+                if append['use']:
+                    # interrupted run will be continued from the same offset
+                    update_state(folder, did, last_id=append['start_message_id'], last_date=append.get('prev_date'),
+                                 last_from_id=append.get('prev'), offset=append['offset'],
+                                 compression=compression or None)
+                    f = DialogFile(orig_file, compression, offset=append['offset'])
+                else:
+                    # saved state doesn't match rewritten file
+                    update_state(folder, did, last_id=None, offset=None)
+                    f = DialogFile(orig_file, compression)
+
+            with stage(dmp, 'rendering'):
+                for m in page['items']:
+                    renderer.render(m)
+                    last_id = m['id']
+                renderer.flush(f)
+
+            for tp, items in renderer.attachments.items():
+                if tp != 'audio_messages' and not dmp._settings['SAVE_DIALOG_ATTACHMENTS']:
+                    items.clear()
+                    continue
+                for a in items:
+                    key = attachment_key(a)
+                    if key in seen[tp]:
+                        continue
+                    seen[tp].add(key)
+                    if manifest.done(key):
+                        downloads.skip(tp, os.path.join(folder, fn, folders[tp]))
+                        continue
+
+                    if tp == 'video_ids':
+                        video_ids.append(a)
+                        if len(video_ids) == 200:
+                            add_videos()
                     else:
-                        values['rev'] = 1
-                        append['use'] = False
-            else:
-                values['rev'] = 1
-        except OSError:
-            values['rev'] = 1
-            append['use'] = False
+                        downloads.add(tp, dmp._download, a, os.path.join(folder, fn, folders[tp]), key=key)
+                items.clear()
+
+            count += len(page['items'])
+            total = '???' if append['use'] else page['count']
+            out('\x1b[2K      {}/{}'.format(count, total), end='\r')
+    except BaseException:
+        if f is not None:
+            # messages after saved offset will be replaced next time
+            renderer.flush(f)
+            f.close()
+        raise
 
-        print('    [кэширование]')
-        print('\x1b[2K      0/???', end='\r')
+    if f is None:
+        manifest.close()
+        out('\x1b[2K      0/0\n')
+        return
 
-        try:
-            history = dmp._vk_tools.get_all(
-                method='messages.getHistory',
-                max_count=200,
-                values=values,
-                negative_offset=append['use'])
-            print('\x1b[2K      {}/{}'.format(len(history['items']),
-                                              history['count']))
-            if len(history['items']) == 0:
-                print()
-                continue
-        except VkToolsException:
-            print('\x1b[2K      0/0\n')
-            continue
-
-        if append['use']:
-            def sortById(msg):
-                return msg['id']
-            history['items'].sort(key=sortById)
-
-        attachments = {
-            'photos': [],
-            'video_ids': [],
-            'docs': [],
-            'audio_messages': []
-        }
+    offset = f.close(marker='[last:{}]\n'.format(last_id))
+    if store is not None:
+        # dialog is marked as stored only when its rows are written
+        store.flush()
+    update_state(folder, did, last_id=last_id, last_date=renderer.prev_date, last_from_id=renderer.prev,
+                 offset=offset, compression=compression or None, stored=True if store is not None else None)
+    out('\x1b[2K      {}/{}'.format(count, total))
 
-        if append['use']:
-            tmp = ''
-        else:
-            f = open(os.path.join(folder, f'{fn}.txt'), 'w', encoding='utf-8')
+    if video_ids:
+        add_videos()
 
-        count = len(history['items'])
-        print('    [сохранение сообщений]')
-        print('      {}/{}'.format(0, count), end='\r')
-        prev = None
-        prev_date = None
+    for tp, title in (('audio_messages', 'голосовых сообщений'), ('photos', 'фото'),
+                      ('video_ids', 'видео'), ('docs', 'документов')):
+        if tp in downloads:
+            out('    [сохранение {}]'.format(title))
+            out('      .../{}'.format(downloads.count(tp)), end='\r')
 
-        if append['use']:
-            prev_date = append['prev_date']
+            with stage(dmp, 'attachments/' + tp):
+                ok, n = downloads.join(tp)
 
-        for i in range(count):
-            m = history['items'][i]
+            out('\x1b[2K      {}/{} (total: {})'.format(ok, n,
+                                                        len(next(os.walk(os.path.join(folder, fn, folders[tp])))[2])))
 
-            if m['from_id'] not in users:
-                users_add(dmp._vk, m['from_id'])
+    manifest.close()
 
-            res = message_handler(dmp._vk, m)
 
-            date = time_handler(m['date'])
-            hold = ' ' * (users.get(m['from_id'])['length'] + 2)
+def dump_messages(dmp, **kwargs):
+    """Сообщения
 
-            msg = res['date'] + ' '
-            msg += hold if (prev and date and prev == m['from_id'] and prev_date == date) \
-                        else users.get(m['from_id'])['name'] + ': '
+    dmp: Dumper object
+    """
+    users = dmp._profiles
 
-            if res['messages']:
-                msg += res['messages'][0] + '\n'
-                for r in res['messages'][1:]:
-                    msg += hold + ' '*8 + r + '\n'
-            else:
-                msg += '\n'
-
-            for a in res['attachments']['audio_messages']:
-                if a not in attachments['audio_messages']:
-                    attachments['audio_messages'].append(a)
-
-            if dmp._settings['SAVE_DIALOG_ATTACHMENTS']:
-                for tp in res['attachments']:
-                    for a in res['attachments'][tp]:
-                        if a not in attachments[tp]:
-                            attachments[tp].append(a)
-
-            if prev_date != date:
-                if prev_date:
-                    if append['use']:
-                        tmp += '\n'
-                    else:
-                        f.write('\n')
-                if append['use']:
-                    tmp += f'        [{date}]\n'
-                else:
-                    f.write(f'        [{date}]\n')
-                prev_date = date
+    folder = os.path.join('dump', 'dialogs')
+    os.makedirs(folder, exist_ok=True)
 
-            if append['use']:
-                tmp += msg
-            else:
-                f.write(msg)
-            prev = m['from_id']
-            print('\x1b[2K      {}/{}'.format(i+1, count), end='\r')
-
-        if append['use']:
-            import codecs
-
-            orig_file = os.path.join(folder, f'{fn}.txt')
-            tmp_file = os.path.join(folder, f'{fn}.new')
-
-            try:
-                with codecs.open(orig_file, 'r', encoding='utf-8') as fi,\
-                     codecs.open(tmp_file, 'w', encoding='utf-8') as fo:
-
-                    for line in fi:
-                        if re.match('^\[last:[0-9]+\]$', line):
-                            line = tmp+'[last:{}]\n'.format(history['items'][-1]['id'])
-                        fo.write(line)
-                os.remove(orig_file)
-                os.rename(tmp_file, orig_file)
-            except Exception:
-                os.remove(tmp_file)
-        else:
-            f.write('[last:{}]\n'.format(history['items'][-1]['id']))
-            f.close()
-        print()
-
-        if attachments['audio_messages']:
-            at_folder = os.path.join(folder, fn)
-            af = os.path.join(at_folder, 'Голосовые')
-            os.makedirs(af, exist_ok=True)
-
-            print('    [сохранение голосовых сообщений]')
-            print('      .../{}'.format(len(attachments['audio_messages'])), end='\r')
-
-            with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-                res = pool.starmap(dmp._download,
-                                   zip(itertools.repeat(dmp.__class__),
-                                       attachments['audio_messages'],
-                                       itertools.repeat(af)))
-
-            print('\x1b[2K      {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                          len(attachments['audio_messages']),
-                                                          len(next(os.walk(af))[2])))
-
-        if dmp._settings['SAVE_DIALOG_ATTACHMENTS']:
-            at_folder = os.path.join(folder, fn)
-            os.makedirs(at_folder, exist_ok=True)
-
-            if attachments['photos']:
-                af = os.path.join(at_folder, 'Фото')
-                os.makedirs(af, exist_ok=True)
-
-                print('    [сохранение фото]')
-                print('      .../{}'.format(len(attachments['photos'])), end='\r')
-
-                with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-                    res = pool.starmap(dmp._download,
-                                       zip(itertools.repeat(dmp.__class__),
-                                           attachments['photos'],
-                                           itertools.repeat(af)))
-
-                print('\x1b[2K      {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                              len(attachments['photos']),
-                                                              len(next(os.walk(af))[2])))
-
-            if attachments['video_ids']:
-                af = os.path.join(at_folder, 'Видео')
-                os.makedirs(af, exist_ok=True)
-
-                videos = dmp._vk_tools.get_all(
-                    method='video.get',
-                    max_count=200,
-                    values={
-                        'videos': ','.join(attachments['video_ids']),
-                        'extended': 1
-                    }
-                )
-
-                print('    [сохранение видео]')
-                print('      .../{}'.format(len(videos['items'])), end='\r')
-
-                try:
-                    with Pool(dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else dmp._settings['POOL_PROCESSES']) as pool:
-                        res = pool.starmap(dmp._download_video,
-                                           zip(itertools.repeat(dmp.__class__),
-                                               videos['items'],
-                                               itertools.repeat(af)))
-                    print('\x1b[2K      {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                                  len(videos['items']),
-                                                                  len(next(os.walk(af))[2])))
-                except MaybeEncodingError:
-                    print('\x1b[2K      ???/{} (total: {})'.format(len(videos['items']), len(next(os.walk(af))[2])))
-
-            if attachments['docs']:
-                af = os.path.join(at_folder, 'Документы')
-                os.makedirs(af, exist_ok=True)
-
-                print('    [сохранение документов]')
-                print('      .../{}'.format(len(attachments['docs'])), end='\r')
-
-                with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-                    res = pool.starmap(dmp._download,
-                                       zip(itertools.repeat(dmp.__class__),
-                                           attachments['docs'],
-                                           itertools.repeat(af)))
-
-                print('\x1b[2K      {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                              len(attachments['docs']),
-                                                              len(next(os.walk(af))[2])))
-
-    with open('users.json', 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=4)
+    print('[получение диалогов...]')
+    print('\x1b[2K  0/???', end='\r')
+
+    with stage(dmp, 'listing'):
+        conversations = get_conversations(dmp._vk)
+        users.harvest(conversations)
+        users.resolve(dmp._vk, [con['conversation']['peer']['id'] for con in conversations['items']
+                               if con['conversation']['peer']['type'] in ('user', 'group')])
+
+    print('\x1b[2K  {}/{}'.format(len(conversations['items']), conversations['count']))
+    if dmp._DUMP_DIALOGS_ONLY:
+        print('[будет сохранено диалогов: {}]'.format(len(dmp._DUMP_DIALOGS_ONLY)), end='\n\n')
+    else:
+        print('[будет исключено диалогов: {}]'.format(len(dmp._EXCLUDED_DIALOGS)), end='\n\n')
+
+    if dmp._settings['DIALOG_COMPRESSION'] == 'zstd' and zstandard is None:
+        print('[zstandard не установлен, будет использован gzip]')
+
+    print('Сохранение диалогов:')
+    files = DialogFiles(folder)
+    store = MessageStore(os.path.join('dump', 'messages.db')) if dmp._settings['MESSAGES_DB'] else None
+    try:
+        save_dialogs(dmp, conversations['items'],
+                     lambda con, out: dialog_handler(dmp, con, folder, out, files, store))
+    finally:
+        if store is not None:
+            store.close()
@@ -1,9 +1,10 @@
 import os
 import os.path
-import itertools
-from multiprocess import Pool
 from operator import itemgetter
 
+from modules.profiling import stage
+from modules.sync_index import SyncIndex, sync_collection
+
 
 def dump_photo(dmp):
     """Фото (по альбомам)
@@ -11,33 +12,40 @@ def dump_photo(dmp):
     dmp: Dumper object
     """
     os.makedirs(os.path.join('dump', 'photo'), exist_ok=True)
-    albums = dmp._vk.photos.getAlbums(need_system=1)
+    with stage(dmp, 'listing'):
+        albums = dmp._vk.photos.getAlbums(need_system=1)
 
     print('Сохранение фото:')
 
+    # albums with the same update time and size are skipped,
+    # only new photos are downloaded
+    index = SyncIndex(os.path.join('dump', '.sync', 'photo.json'))
+
     for al in albums['items']:
         print('  Альбом "{}":'.format(al['title']))
         folder = os.path.join('dump', 'photo', '_'.join(al['title'].split()))
         os.makedirs(folder, exist_ok=True)
 
-        photo = dmp._vk_tools.get_all(
-            method='photos.get',
-            max_count=1000,
-            values={
-                'album_id': al['id'],
-                'photo_sizes': 1
-            })
-
-        if photo['count'] == 0:
-            print('    0/0 (total: {})'.format(len(next(os.walk(folder))[2])))
-        else:
-            print('    .../{}'.format(photo['count']), end='\r')
-            with Pool(dmp._settings['POOL_PROCESSES']) as pool:
-                res = pool.starmap(dmp._download,
-                                   zip(itertools.repeat(dmp.__class__),
-                                       map(lambda p: sorted(p['sizes'], key=itemgetter('width', 'height'))[-1]['url'], photo['items']),
-                                       itertools.repeat(folder)))
-
-            print('\x1b[2K    {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                        photo['count'],
-                                                        len(next(os.walk(folder))[2])))
+        if index.unchanged(al['id'], folder, al.get('updated'), al.get('size')):
+            print('    [без изменений]')
+            continue
+
+        with stage(dmp, 'listing'):
+            photo = dmp._vk_tools.get_all(
+                method='photos.get',
+                max_count=1000,
+                values={
+                    'album_id': al['id'],
+                    'photo_sizes': 1
+                })
+
+        print('    .../{}'.format(photo['count']), end='\r')
+        ok, n, removed = sync_collection(
+            dmp, index, al['id'], folder, dmp._download,
+            {p['id']: {'url': sorted(p['sizes'], key=itemgetter('width', 'height'))[-1]['url'],
+                       'key': 'photo{}_{}'.format(p['owner_id'], p['id'])} for p in photo['items']},
+            updated=al.get('updated'), size=al.get('size'))
+
+        print('\x1b[2K    {}/{} (total: {}){}'.format(ok, n,
+                                                      len(next(os.walk(folder))[2]),
+                                                      f' [удалено: {removed}]' if removed else ''))
@@ -0,0 +1,144 @@
+import os
+import os.path
+import json
+import time
+import sqlite3
+import threading
+
+from vk_api.exceptions import ApiError
+
+UNKNOWN = {'name': r'{unknown user}', 'length': 14}
+
+
+class Profiles:
+    """
+    Persistent cache of users' and groups' names shared by all modules
+
+    Profiles are stored in SQLite database as {id: name} and returned
+    as {name: str, length: len(name)}, where id < 0 for groups.
+    Database is opened on first access, profiles are loaded on demand.
+
+    path: database file
+    ttl: profile lifetime in days (0 - never expire)
+    legacy: users.json to be imported on database creation
+    """
+    def __init__(self, path='users.db', ttl=0, legacy='users.json'):
+        self._path = path
+        self._ttl = ttl * 24 * 60 * 60
+        self._legacy = legacy
+        self._db = None
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._db is None:
+            new = not os.path.exists(self._path)
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS profiles ('
+                             'id INTEGER PRIMARY KEY, name TEXT NOT NULL, updated INTEGER NOT NULL)')
+            if new and self._legacy and os.path.exists(self._legacy):
+                with open(self._legacy, 'r', encoding='utf-8') as f:
+                    legacy = json.load(f)
+                # unknown update time: will be refreshed as soon as ttl is set
+                self._db.executemany('INSERT OR REPLACE INTO profiles VALUES (?, ?, 0)',
+                                     [(int(pid), u['name']) for pid, u in legacy.items()
+                                      if u['name'] != UNKNOWN['name']])
+            self._db.commit()
+        return self._db
+
+    def _load(self, ids):
+        """Loads not cached profiles from database"""
+        ids = [pid for pid in ids if pid not in self._cache]
+        if not ids:
+            return
+        with self._lock:
+            db = self._connect()
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                for pid, name, updated in db.execute(
+                        'SELECT id, name, updated FROM profiles WHERE id IN ({})'.format(','.join('?' * len(chunk))),
+                        chunk):
+                    self._cache[pid] = ({'name': name, 'length': len(name)}, updated)
+
+    def _fresh(self, pid):
+        return (pid in self._cache) and \
+               (not self._ttl or self._cache[pid][1] > time.time() - self._ttl)
+
+    def __contains__(self, pid):
+        self._load((pid,))
+        return self._fresh(pid)
+
+    def __getitem__(self, pid):
+        self._load((pid,))
+        return self._cache[pid][0]
+
+    def get(self, pid, default=None):
+        try:
+            return self[pid]
+        except KeyError:
+            return default
+
+    def add(self, profiles):
+        """
+        Adds profiles to cache and writes them to database
+
+        profiles: iterable of tuples (id, name)
+        """
+        now = int(time.time())
+        profiles = list(profiles)
+        with self._lock:
+            for pid, name in profiles:
+                self._cache[pid] = ({'name': name, 'length': len(name)}, now)
+            db = self._connect()
+            db.executemany('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)',
+                           [(pid, name, now) for pid, name in profiles])
+            db.commit()
+
+    def harvest(self, obj):
+        """
+        Adds profiles and groups of extended API response
+
+        obj: object with "profiles" and/or "groups" arrays
+        """
+        profiles = []
+        for u in obj.get('profiles') or []:
+            # User: {..., first_name, last_name, id, ...} -> (id, 'first_name last_name')
+            if (u.get('deactivated') == 'deleted') and (u['first_name'] == 'DELETED'):
+                profiles.append((u['id'], 'DELETED'))
+            else:
+                profiles.append((u['id'], u['first_name'] + ' ' + u['last_name']))
+        for g in obj.get('groups') or []:
+            # Group: {..., name, id, ...} -> (-id, 'name')
+            profiles.append((-g['id'], g['name']))
+        if profiles:
+            self.add(profiles)
+
+    def resolve(self, vk, ids):
+        """
+        Gets info about all unknown or expired profiles with batched requests
+
+        vk: vk_api
+        ids: iterable of profile ids
+        """
+        ids = [pid for pid in set(ids) if pid]
+        self._load(ids)
+        unknown = [pid for pid in ids if not self._fresh(pid)]
+        user_ids = [pid for pid in unknown if pid > 0]
+        group_ids = [-pid for pid in unknown if pid < 0]
+
+        for i in range(0, len(user_ids), 1000):
+            try:
+                self.harvest({'profiles': vk.users.get(user_ids=','.join(map(str, user_ids[i:i+1000])))})
+            except ApiError:
+                pass
+        for i in range(0, len(group_ids), 500):
+            try:
+                self.harvest({'groups': vk.groups.getById(group_ids=','.join(map(str, group_ids[i:i+500])))})
+            except ApiError:
+                pass
+
+        with self._lock:
+            for pid in unknown:
+                if pid not in self._cache:
+                    # not saved: will be requested again on next run
+                    self._cache[pid] = (UNKNOWN, time.time())
@@ -0,0 +1,181 @@
+import os
+import os.path
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+class Profiler:
+    """
+    Wall time and peak memory (tracemalloc) of dump targets and their stages
+
+    Report is saved as JSON:
+        {"argv": [...], "started": int, "seconds": float,
+         "targets": [{"name": str, "seconds": float, "peak_memory": int,
+                      "stages": {stage: {"seconds": float, "calls": int, "peak_memory": int}},
+                      "cprofile": file or null}, ...]}
+    Time of stage is summed over all threads running it, peak memory
+    of stage is the peak traced while it was running (including other
+    stages running at the same time).
+
+    Before Python 3.12 cProfile traces only the thread it is enabled in,
+    since 3.12 a second profiler can't be enabled in worker threads,
+    so with cprofile dialogs are saved in the main thread, see workers().
+
+    path: report file
+    cprofile: save cProfile stats of each target ({path}_{target}.prof)
+    """
+    def __init__(self, path='profile.json', cprofile=False):
+        self._path = path
+        self.cprofile = cprofile
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._start = time.perf_counter()
+        self._targets = []
+        self._current = None
+        self._prof = None
+        self._active = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tracemalloc.start()
+
+    def _peak(self):
+        return tracemalloc.get_traced_memory()[1]
+
+    def _reset_peak(self):
+        # tracemalloc.reset_peak() appeared in Python 3.9
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def target(self, name):
+        """
+        Profiles dump target, targets may be nested
+        (menu's "dump all" runs every target)
+
+        name: dump function name
+        """
+        t = {'name': name, 'seconds': 0, 'peak_memory': 0, 'stages': {}, 'cprofile': None}
+        with self._lock:
+            self._targets.append(t)
+            outer, self._current = self._current, t
+            self._reset_peak()
+
+        prof = cProfile.Profile() if self.cprofile else None
+        outer_prof, self._prof = self._prof, prof
+        start = time.perf_counter()
+        if prof:
+            # only one profiler can be enabled since Python 3.12,
+            # outer target is paused while inner one is running
+            if outer_prof:
+                outer_prof.disable()
+            prof.enable()
+        try:
+            yield
+        finally:
+            if prof:
+                prof.disable()
+                if outer_prof:
+                    outer_prof.enable()
+            self._prof = outer_prof
+            with self._lock:
+                t['seconds'] = round(time.perf_counter() - start, 4)
+                t['peak_memory'] = max([self._peak()] + [s['peak_memory'] for s in t['stages'].values()])
+                self._current = outer
+            if prof:
+                t['cprofile'] = self._save_cprofile(name, prof)
+
+    def _save_cprofile(self, name, prof):
+        stats = pstats.Stats(prof)
+        path = '{}_{}.prof'.format(os.path.splitext(self._path)[0], name)
+        stats.dump_stats(path)
+        return path
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Profiles stage of current target
+
+        name: stage name (listing, history, rendering, ...)
+        """
+        with self._lock:
+            t = self._current
+            if t is not None:
+                if not self._active:
+                    self._reset_peak()
+                self._active += 1
+        if t is None:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._active -= 1
+                s = t['stages'].setdefault(name, {'seconds': 0, 'calls': 0, 'peak_memory': 0})
+                s['seconds'] = round(s['seconds'] + seconds, 4)
+                s['calls'] += 1
+                s['peak_memory'] = max(s['peak_memory'], self._peak())
+
+    def report(self):
+        with self._lock:
+            return {'argv': sys.argv, 'started': int(self._started),
+                    'seconds': round(time.perf_counter() - self._start, 4),
+                    'targets': self._targets}
+
+    def save(self):
+        """Writes report"""
+        report = self.report()
+        with open(self._path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        tracemalloc.stop()
+        return report
+
+
+def stage(dmp, name):
+    """
+    Returns context manager profiling stage of current target
+    (does nothing if profiling is off)
+
+    dmp: Dumper object
+    """
+    return dmp._profiler.stage(name) if dmp._profiler is not None else nullcontext()
+
+
+def stage_iter(dmp, name, iterable):
+    """
+    Yields items of iterable, time of receiving them is
+    profiled as stage (e.g. pages of API responses)
+
+    dmp: Dumper object
+    """
+    if dmp._profiler is None:
+        yield from iterable
+        return
+    it = iter(iterable)
+    while True:
+        with dmp._profiler.stage(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+def workers(dmp):
+    """
+    Returns number of dialogs saved at once (DIALOG_WORKERS),
+    1 if cProfile is on: worker threads can't be profiled
+
+    dmp: Dumper object
+    """
+    if dmp._profiler is not None and dmp._profiler.cprofile:
+        return 1
+    return dmp._settings['DIALOG_WORKERS']
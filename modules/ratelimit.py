@@ -0,0 +1,85 @@
+import time
+import threading
+
+from vk_api.exceptions import TOO_MANY_RPS_CODE
+
+
+class RateLimiter:
+    """
+    Limits rate of VK API requests made by all threads through one session
+
+    Requests are spaced by 1/rps seconds. Throttled requests
+    ("Too many requests per second") are retried with exponential backoff,
+    and the following requests of all threads are delayed as well.
+
+    rps: max number of requests per second
+    retries: max number of retries of one throttled request
+    backoff: delay before the first retry in seconds, doubled on each retry
+    """
+    def __init__(self, rps=3, retries=5, backoff=0.5):
+        self.rps = rps
+        self.retries = retries
+        self.backoff = backoff
+        self._next = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {'requests': 0, 'throttled': 0, 'retries': 0, 'failed': 0, 'wait': 0.0}
+
+    @property
+    def stats(self):
+        """
+        {requests: int, throttled: int, retries: int, failed: int, wait: float},
+            where throttled - number of "Too many requests" errors,
+            failed - requests failed after all retries,
+            wait - total time spent waiting in seconds
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def install(self, vk_session):
+        """
+        Wraps vk_session.method, replaces built-in delay and error 6 handler
+
+        vk_session: vk_api.VkApi
+        """
+        method = vk_session.method
+
+        def limited(*args, **kwargs):
+            self.wait()
+            return method(*args, **kwargs)
+
+        vk_session.RPS_DELAY = 0
+        vk_session.method = limited
+        vk_session.error_handlers[TOO_MANY_RPS_CODE] = self._too_many_rps
+
+    def wait(self, delay=0):
+        """
+        Blocks until the next request is allowed
+
+        delay: min time to wait in seconds
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now + delay)
+            self._next = start + (1 / self.rps if self.rps > 0 else 0)
+            self._stats['requests'] += 1
+            self._stats['wait'] += start - now
+        if start > now:
+            time.sleep(start - now)
+
+    def _too_many_rps(self, error):
+        attempt = getattr(self._local, 'attempt', 0)
+        with self._lock:
+            self._stats['throttled'] += 1
+            if attempt >= self.retries:
+                self._stats['failed'] += 1
+                return None
+            self._stats['retries'] += 1
+            # delay requests of other threads too
+            self._next = max(self._next, time.monotonic() + self.backoff * 2**attempt)
+
+        self._local.attempt = attempt + 1
+        try:
+            return error.try_method()
+        finally:
+            self._local.attempt = attempt
@@ -0,0 +1,45 @@
+import os
+import os.path
+import json
+
+
+def state_path(folder, did, ext='json'):
+    """
+    Returns path of dialog's sidecar file: {folder}/.state/{did}.{ext}
+
+    folder: folder of dialogs
+    did: peer id
+    """
+    return os.path.join(folder, '.state', f'{did}.{ext}')
+
+
+def load_state(folder, did):
+    """
+    Returns saved state of dialog, {} if there is none
+
+    folder: folder of dialogs
+    did: peer id
+    """
+    try:
+        with open(state_path(folder, did), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_state(folder, did, **values):
+    """
+    Updates saved state of dialog, None values are removed
+
+    folder: folder of dialogs
+    did: peer id
+    """
+    state = load_state(folder, did)
+    state.update(values)
+    state = {k: v for k, v in state.items() if v is not None}
+
+    path = state_path(folder, did)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
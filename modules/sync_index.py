@@ -0,0 +1,135 @@
+import os
+import os.path
+import json
+import threading
+
+from modules._download import _path
+from modules.executor import Downloads
+from modules.profiling import stage
+
+
+class SyncIndex:
+    """
+    Index of synced items of albums and other collections
+
+    Stored as JSON {collection_id: {folder, updated, size, complete, items}},
+    where items - {item_id: filename} of downloaded items
+
+    path: index file
+    """
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+
+    def unchanged(self, cid, folder, updated, size):
+        """
+        Returns True if collection was completely synced
+        and its updated/size are the same
+
+        cid: collection id
+        updated: update time or None if it is unknown
+        """
+        e = self._index.get(str(cid))
+        return e is not None and e['complete'] and e['folder'] == folder and \
+            updated is not None and e['updated'] == updated and e['size'] == size
+
+    def plan(self, cid, folder, ids):
+        """
+        Returns (new, deleted) ids of collection
+
+        cid: collection id
+        folder: folder of collection, index is reset if it's changed
+        ids: ids of all items in collection
+        """
+        with self._lock:
+            e = self._index.get(str(cid))
+            if e is None or e['folder'] != folder:
+                e = self._index[str(cid)] = {'folder': folder, 'updated': None, 'size': None,
+                                             'complete': False, 'items': {}}
+            ids = [str(i) for i in ids]
+            new = [i for i in ids if i not in e['items']]
+            deleted = set(e['items']) - set(ids)
+            return new, deleted
+
+    def add(self, cid, item_id, filename):
+        with self._lock:
+            self._index[str(cid)]['items'][str(item_id)] = filename
+
+    def remove(self, cid, item_id):
+        """Removes item, returns its filename"""
+        with self._lock:
+            return self._index[str(cid)]['items'].pop(str(item_id), None)
+
+    def commit(self, cid, updated, size, complete):
+        """
+        Saves collection state
+
+        complete: all items were downloaded
+        """
+        with self._lock:
+            e = self._index[str(cid)]
+            e.update(updated=updated, size=size, complete=complete)
+
+    def prune(self, cid, deleted):
+        """
+        Removes files of deleted items, returns number of removed files
+        """
+        n = 0
+        folder = self._index[str(cid)]['folder']
+        for i in deleted:
+            filename = self.remove(cid, i)
+            if filename:
+                try:
+                    os.remove(os.path.join(folder, filename))
+                    n += 1
+                except FileNotFoundError:
+                    pass
+        return n
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(self._path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self._index, f, ensure_ascii=False)
+            os.replace(self._path + '.tmp', self._path)
+
+
+def sync_collection(dmp, index, cid, folder, fn, items, updated=None, size=None, limit=None):
+    """
+    Downloads new items of collection, files of deleted items
+    are removed if SYNC_PRUNE is set
+
+    Returns (succeeded, new, removed)
+
+    dmp: Dumper object
+    index: SyncIndex
+    cid: collection id
+    fn: download function
+    items: {item_id: download object}
+    updated, size: collection's update time and size
+    limit: max number of simultaneously running tasks
+    """
+    new, deleted = index.plan(cid, folder, items.keys())
+    new = set(new)
+
+    def on_done(group, obj, folder, result, key):
+        if result:
+            path = _path(dmp, fn, obj, folder)
+            index.add(cid, key, os.path.basename(path) if path else None)
+
+    with stage(dmp, 'download'):
+        downloads = Downloads(dmp, on_done=on_done)
+        for i in items:
+            if str(i) in new:
+                downloads.add(cid, fn, items[i], folder, limit, key=i)
+        ok, n = downloads.join(cid) if cid in downloads else (0, 0)
+
+    removed = index.prune(cid, deleted) if dmp._settings['SYNC_PRUNE'] else 0
+    index.commit(cid, updated, size, ok == n)
+    index.save()
+    return ok, n, removed
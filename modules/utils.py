@@ -1,11 +1,196 @@
-def get_attachments(vk, peer_id, media_fave_type):
+import io
+import os
+import os.path
+import re
+import gzip
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from modules.profiling import workers as dialog_workers
+
+
+class Output:
+    """
+    Buffered console output of one of concurrently processed objects
+    (dialogs, ...), printed at once by flush()
+
+    Progress lines (printed with end='\\r') are skipped.
+    """
+    def __init__(self):
+        self._lines = []
+
+    def __call__(self, *args, sep=' ', end='\n'):
+        if end != '\r':
+            self._lines.append(sep.join(map(str, args)) + end)
+
+    def flush(self):
+        print(''.join(self._lines), end='', flush=True)
+        self._lines.clear()
+
+
+def save_dialogs(dmp, conversations, handler):
+    """
+    Calls handler(con, out) for each conversation in DIALOG_WORKERS threads
+    (in the main thread with --cprofile), output of each dialog is printed
+    at once when it is saved
+
+    On error or KeyboardInterrupt dialogs which haven't started yet are
+    cancelled, only the running ones are finished.
+
+    dmp: Dumper object
+    conversations: array of objects
+    handler: function(con, out), out - print-like function
+    """
+    workers = dialog_workers(dmp)
+    if workers <= 1:
+        for con in conversations:
+            handler(con, print)
+        return
+
+    def worker(con):
+        out = Output()
+        handler(con, out)
+        return out
+
+    pool = ThreadPoolExecutor(workers)
+    futures = []
+    try:
+        futures.extend(pool.submit(worker, con) for con in conversations)
+        for fut in as_completed(futures):
+            fut.result().flush()
+    except BaseException:
+        # shutdown(cancel_futures=True) appeared in Python 3.9
+        for fut in futures:
+            fut.cancel()
+        pool.shutdown(wait=False)
+        raise
+    pool.shutdown()
+
+
+class DialogFile:
+    """
+    Text file of dialog, optionally compressed
+
+    Compressed file is a sequence of gzip members (zstd frames):
+    messages written by each run are a new member and "[last:N]" marker
+    is a separate one, so new messages are appended after truncating
+    the marker member, without decompressing the rest of the file.
+
+    path: file
+    compression: '' (none), gzip or zstd
+    offset: file is truncated at offset and appended, None - rewritten
+    """
+    SUFFIXES = {'': '.txt', 'gzip': '.txt.gz', 'zstd': '.txt.zst'}
+
+    def __init__(self, path, compression='', offset=None):
+        self._compression = compression
+        self._raw = open(path, 'wb' if offset is None else 'r+b')
+        if offset is not None:
+            self._raw.truncate(offset)
+            self._raw.seek(offset)
+
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        elif compression == 'zstd':
+            stream = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            stream = self._raw
+        self._text = io.TextIOWrapper(stream, encoding='utf-8')
+
+    def _compress(self, data):
+        if self._compression == 'gzip':
+            return gzip.compress(data)
+        elif self._compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    def write(self, s):
+        return self._text.write(s)
+
+    def close(self, marker=None):
+        """
+        Finishes written member, writes marker as a separate one
+
+        Returns offset of marker
+        """
+        self._text.flush()
+        stream = self._text.detach()
+        if stream is not self._raw:
+            stream.close()
+        offset = self._raw.tell()
+        if marker is not None:
+            self._raw.write(self._compress(marker.encode('utf-8')))
+        self._raw.close()
+        return offset
+
+
+class DialogFiles:
+    """
+    Index of files and folders of dialogs {peer_id: [(name, suffix), ...]},
+    built once from folder listing and updated on renames
+
+    File "{name}_{peer_id}{suffix}" is indexed with its full suffix
+    (".txt", ".txt.gz", "" for folder of attachments)
+
+    folder: folder of dialogs
+    """
+    _NAME = re.compile(r'^(.*_(-?\d+))((?:\.[0-9A-Za-z]+)*)$')
+
+    def __init__(self, folder):
+        self._folder = folder
+        self._index = {}
+        self._lock = threading.Lock()
+        for n in os.listdir(folder):
+            r = self._NAME.match(n)
+            if r:
+                self._index.setdefault(int(r.group(2)), []).append((r.group(1), r.group(3)))
+
+    def get(self, did):
+        """Returns [(name, suffix), ...] of dialog"""
+        with self._lock:
+            return list(self._index.get(did, ()))
+
+    def resolve(self, dmp, did, dialog_name):
+        """
+        Returns file name (without suffix) of dialog,
+        existing files are renamed if KEEP_DIALOG_NAMES is off
+
+        dmp: Dumper object
+        did: peer id
+        dialog_name: current name of dialog
+        """
+        fn = '{}_{id}'.format('_'.join(dialog_name.split(' ')), id=did)
+        with self._lock:
+            files = self._index.get(did)
+            if not files:
+                return fn
+            if dmp._settings['KEEP_DIALOG_NAMES']:
+                return files[-1][0]
+
+            for i, (name, suffix) in enumerate(files):
+                if name != fn:
+                    shutil.move(os.path.join(self._folder, name + suffix),
+                                os.path.join(self._folder, fn + suffix))
+                    files[i] = (fn, suffix)
+            return fn
+
+
+def get_attachments(vk, peer_id, media_fave_type, stop_message_id=0):
     """
     Return object {count: int, items: array of objects},
-        where items - {media_fave_type} attachments
+        where items - {media_fave_type} attachments (newest first)
 
     vk: vk_api
     peer_id: int
     media_fave_type: str (photo, video, doc)
+    stop_message_id: only attachments of newer messages are returned,
+                     paging stops as soon as older one is found
     """
     def generate_code(peer_id, media_fave_type, start_from=0):
         code = '''
@@ -14,17 +199,20 @@ def get_attachments(vk, peer_id, media_fave_type):
 
             var len = res.items.length;
             var next = res.next_from;
+            var last = 0;
+            if (len > 0) last = res.items[len-1].message_id;
 
             delete res;
 
             var i = 1;
 
-            while ((len > 0) && (i < 25)) {
+            while ((len > 0) && (i < 25) && (last > {arg_stop_message_id})) {
                 var tmp = API.messages.getHistoryAttachments({"start_from": next, "peer_id": {arg_peer_id}, "media_type": "{arg_media_fave_type}", "count": 200, "photo_sizes": 1});
 
                 len = tmp.items.length;
                 if (len > 0) {
                     next = tmp.next_from;
+                    last = tmp.items[len-1].message_id;
                     ans.push(tmp.items);
                     i = i+1;
                 }
@@ -34,17 +222,23 @@ def get_attachments(vk, peer_id, media_fave_type):
             else return {"items": ans};
         '''.replace('{arg_start_from}', str(start_from)) \
            .replace('{arg_peer_id}', str(peer_id)) \
-           .replace('{arg_media_fave_type}', media_fave_type)
+           .replace('{arg_media_fave_type}', media_fave_type) \
+           .replace('{arg_stop_message_id}', str(stop_message_id))
         return code
 
     res = {'count': 0, 'items': []}
     start_from = 0
     while True:
         tmp = vk.execute(code=generate_code(peer_id, media_fave_type, start_from))
+        stop = False
         for t in tmp['items']:
-            res['items'].extend(t)
+            for item in t:
+                if item['message_id'] > stop_message_id:
+                    res['items'].append(item)
+                else:
+                    stop = True
         start_from = tmp.get('next_from')
-        if not start_from:
+        if stop or not start_from:
             break
     res['count'] = len(res['items'])
     return res
@@ -111,3 +305,172 @@ def get_fave(vk, fave_type):
             break
     res['count'] = len(res['items'])
     return res
+
+
+def get_conversations(vk):
+    """
+    Returns object {count: int, items: array of objects,
+                    profiles: array of objects, groups: array of objects},
+        where profiles and groups - extended info about conversations' peers
+
+    vk: vk_api
+    """
+    def generate_code(offset):
+        code = '''
+            var res = API.messages.getConversations({"offset": {arg_offset}, "count": 200, "extended": 1, "fields": "first_name,last_name,name"});
+            var ans = [res.items];
+            var profiles = [res.profiles];
+            var groups = [res.groups];
+            var count = res.count;
+
+            var len = res.items.length;
+            var offset = {arg_offset} + len;
+
+            delete res;
+
+            var i = 1;
+
+            while ((len > 0) && (i < 25)) {
+                var tmp = API.messages.getConversations({"offset": offset, "count": 200, "extended": 1, "fields": "first_name,last_name,name"});
+
+                len = tmp.items.length;
+                if (len > 0) {
+                    offset = offset + len;
+                    ans.push(tmp.items);
+                    profiles.push(tmp.profiles);
+                    groups.push(tmp.groups);
+                    i = i+1;
+                }
+            }
+
+            if (len>0) return {"count": count, "offset": offset, "items": ans, "profiles": profiles, "groups": groups};
+            else return {"count": count, "items": ans, "profiles": profiles, "groups": groups};
+        '''.replace('{arg_offset}', str(offset))
+        return code
+
+    res = {'count': 0, 'items': [], 'profiles': [], 'groups': []}
+    offset = 0
+    while True:
+        tmp = vk.execute(code=generate_code(offset))
+        for key in ('items', 'profiles', 'groups'):
+            for t in tmp[key]:
+                if t:
+                    res[key].extend(t)
+        res['count'] = tmp['count']
+        offset = tmp.get('offset')
+        if not offset:
+            break
+    return res
+
+
+def get_history(vk, peer_id, start_message_id=None):
+    """
+    Yields pages of dialog history from oldest to newest messages
+    as objects {count: int, items: array of objects,
+                profiles: array of objects, groups: array of objects}
+
+    Up to 25 pages (200 messages each) are received with one execute request.
+
+    vk: vk_api
+    peer_id: int
+    start_message_id: int, get only messages newer than it
+    """
+    def generate_code(peer_id, offset):
+        code = '''
+            var res = API.messages.getHistory({"peer_id": {arg_peer_id}, "rev": 1, "offset": {arg_offset}, "count": 200, "extended": 1, "fields": "first_name,last_name"});
+            var ans = [res.items];
+            var profiles = [res.profiles];
+            var groups = [res.groups];
+            var count = res.count;
+
+            var len = res.items.length;
+            var offset = {arg_offset} + len;
+
+            delete res;
+
+            var i = 1;
+
+            while ((len == 200) && (i < 25)) {
+                var tmp = API.messages.getHistory({"peer_id": {arg_peer_id}, "rev": 1, "offset": offset, "count": 200, "extended": 1, "fields": "first_name,last_name"});
+
+                len = tmp.items.length;
+                offset = offset + len;
+                ans.push(tmp.items);
+                profiles.push(tmp.profiles);
+                groups.push(tmp.groups);
+                i = i+1;
+            }
+
+            return {"count": count, "offset": offset, "items": ans, "profiles": profiles, "groups": groups};
+        '''.replace('{arg_peer_id}', str(peer_id)) \
+           .replace('{arg_offset}', str(offset))
+        return code
+
+    def generate_append_code(peer_id, start_message_id):
+        # offset < 0: messages newer than start_message_id (newest first),
+        # start_message_id is moved to the newest received message
+        code = '''
+            var res = API.messages.getHistory({"peer_id": {arg_peer_id}, "start_message_id": {arg_start_message_id}, "offset": -200, "count": 200, "extended": 1, "fields": "first_name,last_name"});
+            var ans = [res.items];
+            var profiles = [res.profiles];
+            var groups = [res.groups];
+            var count = res.count;
+
+            var len = res.items.length;
+            var prev = {arg_start_message_id};
+            var start = prev;
+            if (len > 0) {
+                start = res.items[0].id;
+            }
+
+            delete res;
+
+            var i = 1;
+
+            while ((len > 0) && (i < 25) && (start > prev)) {
+                prev = start;
+                var tmp = API.messages.getHistory({"peer_id": {arg_peer_id}, "start_message_id": prev, "offset": -200, "count": 200, "extended": 1, "fields": "first_name,last_name"});
+
+                len = tmp.items.length;
+                if (len > 0) {
+                    start = tmp.items[0].id;
+                }
+                ans.push(tmp.items);
+                profiles.push(tmp.profiles);
+                groups.push(tmp.groups);
+                i = i+1;
+            }
+
+            return {"count": count, "items": ans, "profiles": profiles, "groups": groups};
+        '''.replace('{arg_peer_id}', str(peer_id)) \
+           .replace('{arg_start_message_id}', str(start_message_id))
+        return code
+
+    offset = 0
+    while True:
+        if start_message_id:
+            tmp = vk.execute(code=generate_append_code(peer_id, start_message_id))
+        else:
+            tmp = vk.execute(code=generate_code(peer_id, offset))
+
+        more = False
+        for items, profiles, groups in zip(tmp['items'], tmp['profiles'], tmp['groups']):
+            if start_message_id:
+                items = sorted([m for m in items if m['id'] > start_message_id], key=lambda m: m['id'])
+                more = len(items) > 0
+                if items:
+                    start_message_id = items[-1]['id']
+            else:
+                more = len(items) == 200
+
+            if items:
+                yield {
+                    'count': tmp['count'],
+                    'items': items,
+                    'profiles': profiles or [],
+                    'groups': groups or []
+                }
+
+        if not more:
+            break
+        offset = tmp.get('offset')
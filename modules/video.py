@@ -1,7 +1,8 @@
 import os
 import os.path
-import itertools
-from multiprocess import Pool
+
+from modules.profiling import stage
+from modules.sync_index import SyncIndex, sync_collection
 
 
 def dump_video(dmp):
@@ -14,35 +15,42 @@ def dump_video(dmp):
 
     print('Сохранение видео:')
 
-    albums = dmp._vk_tools.get_all(
-        method='video.getAlbums',
-        max_count=100,
-        values={
-            'need_system': 1
-        })
+    with stage(dmp, 'listing'):
+        albums = dmp._vk_tools.get_all(
+            method='video.getAlbums',
+            max_count=100,
+            values={
+                'need_system': 1
+            })
+
+    # albums with the same update time and size are skipped,
+    # only new videos are downloaded
+    index = SyncIndex(os.path.join('dump', '.sync', 'video.json'))
 
     for al in albums['items']:
         print('  Альбом "{}":'.format(al['title']))
         folder = os.path.join('dump', 'video', '_'.join(al['title'].split()))
         os.makedirs(folder, exist_ok=True)
 
-        video = dmp._vk_tools.get_all(
-            method='video.get',
-            max_count=200,
-            values={
-                'album_id': al['id']
-            })
-
-        if video['count'] == 0:
-            print('    0/0 (total: {})'.format(len(next(os.walk(folder))[2])))
-        else:
-            print('    .../{}'.format(len(video['items'])), end='\r')
-            with Pool(dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else dmp._settings['POOL_PROCESSES']) as pool:
-                res = pool.starmap(dmp._download_video,
-                                   zip(itertools.repeat(dmp.__class__),
-                                       video['items'],
-                                       itertools.repeat(folder)))
-
-            print('\x1b[2K    {}/{} (total: {})'.format(sum(filter(None, res)),
-                                                        len(video['items']),
-                                                        len(next(os.walk(folder))[2])))
+        if index.unchanged(al['id'], folder, al.get('updated_time'), al.get('count')):
+            print('    [без изменений]')
+            continue
+
+        with stage(dmp, 'listing'):
+            video = dmp._vk_tools.get_all(
+                method='video.get',
+                max_count=200,
+                values={
+                    'album_id': al['id']
+                })
+
+        print('    .../{}'.format(len(video['items'])), end='\r')
+        ok, n, removed = sync_collection(
+            dmp, index, al['id'], folder, dmp._download_video,
+            {'{}_{}'.format(v['owner_id'], v['id']): v for v in video['items']},
+            updated=al.get('updated_time'), size=al.get('count'),
+            limit=dmp._AVAILABLE_THREADS if dmp._settings['LIMIT_VIDEO_PROCESSES'] else None)
+
+        print('\x1b[2K    {}/{} (total: {}){}'.format(ok, n,
+                                                      len(next(os.walk(folder))[2]),
+                                                      f' [удалено: {removed}]' if removed else ''))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules and benchmarks/synthetic.py are imported by tests
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
@@ -0,0 +1,116 @@
+import os
+import gzip
+
+import pytest
+
+from modules.utils import DialogFile, DialogFiles, zstandard
+
+COMPRESSIONS = ['', 'gzip', pytest.param('zstd', marks=pytest.mark.skipif(zstandard is None,
+                                                                          reason='zstandard is not installed'))]
+
+FIRST = '        [1 января 2020]\n[10:00] Имя: привет\n'
+SECOND = '[10:01]       как дела\n\n        [2 января 2020]\n[11:00] Имя: ok\n'
+
+
+def decompress(data, compression):
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    elif compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def read(path, compression):
+    """Returns decompressed text of dialog file"""
+    with open(path, 'rb') as f:
+        if compression == 'gzip':
+            data = gzip.decompress(f.read())
+        elif compression == 'zstd':
+            data = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True).read()
+        else:
+            data = f.read()
+    return data.decode('utf-8')
+
+
+def write(path, compression, text, marker=None, offset=None):
+    f = DialogFile(path, compression, offset=offset)
+    f.write(text)
+    return f.close(marker=marker)
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_close_returns_marker_offset(tmp_path, compression):
+    path = str(tmp_path / ('dialog' + DialogFile.SUFFIXES[compression]))
+    offset = write(path, compression, FIRST, marker='[last:1]\n')
+
+    assert read(path, compression) == FIRST + '[last:1]\n'
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        marker = f.read()
+    # marker is a separate member (frame)
+    assert decompress(marker, compression) == b'[last:1]\n'
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_append(tmp_path, compression):
+    suffix = DialogFile.SUFFIXES[compression]
+    path = str(tmp_path / ('dialog' + suffix))
+    offset = write(path, compression, FIRST, marker='[last:1]\n')
+    write(path, compression, SECOND, marker='[last:3]\n', offset=offset)
+
+    full = str(tmp_path / ('full' + suffix))
+    write(full, compression, FIRST + SECOND, marker='[last:3]\n')
+
+    assert read(path, compression) == read(full, compression) == FIRST + SECOND + '[last:3]\n'
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_append_after_interrupted_run(tmp_path, compression):
+    # interrupted run is closed without marker, the next one
+    # truncates its messages at the same offset
+    path = str(tmp_path / ('dialog' + DialogFile.SUFFIXES[compression]))
+    offset = write(path, compression, FIRST, marker='[last:1]\n')
+    assert write(path, compression, SECOND[:20], offset=offset) > offset
+    write(path, compression, SECOND, marker='[last:3]\n', offset=offset)
+
+    assert read(path, compression) == FIRST + SECOND + '[last:3]\n'
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_rewrite(tmp_path, compression):
+    path = str(tmp_path / ('dialog' + DialogFile.SUFFIXES[compression]))
+    write(path, compression, FIRST + SECOND, marker='[last:3]\n')
+    write(path, compression, FIRST, marker='[last:1]\n')
+
+    assert read(path, compression) == FIRST + '[last:1]\n'
+
+
+def test_dialog_files(tmp_path):
+    for name in ('Имя_Фамилия_100.txt', 'Беседа_2_2000000002.txt.gz', 'Сообщество_-5.txt.zst', 'notes.txt'):
+        (tmp_path / name).write_text('')
+    for name in ('Беседа_2_2000000002', '.state'):
+        (tmp_path / name).mkdir()
+
+    files = DialogFiles(str(tmp_path))
+    assert files.get(100) == [('Имя_Фамилия_100', '.txt')]
+    assert sorted(files.get(2000000002)) == [('Беседа_2_2000000002', ''), ('Беседа_2_2000000002', '.txt.gz')]
+    assert files.get(-5) == [('Сообщество_-5', '.txt.zst')]
+    assert files.get(2) == []
+
+
+class Dumper:
+    def __init__(self, keep):
+        self._settings = {'KEEP_DIALOG_NAMES': keep}
+
+
+def test_dialog_files_resolve(tmp_path):
+    (tmp_path / 'Старое_имя_100.txt').write_text('text')
+    (tmp_path / 'Старое_имя_100').mkdir()
+
+    files = DialogFiles(str(tmp_path))
+    assert files.resolve(Dumper(True), 100, 'Новое имя') == 'Старое_имя_100'
+    assert files.resolve(Dumper(False), 100, 'Новое имя') == 'Новое_имя_100'
+    assert sorted(os.listdir(str(tmp_path))) == ['Новое_имя_100', 'Новое_имя_100.txt']
+    assert (tmp_path / 'Новое_имя_100.txt').read_text() == 'text'
+    assert files.resolve(Dumper(True), 100, 'Другое имя') == 'Новое_имя_100'
+    assert files.resolve(Dumper(False), 200, 'Другое имя') == 'Другое_имя_200'
@@ -0,0 +1,65 @@
+import os
+
+from modules.manifest import Manifest
+
+
+def lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.readlines()
+
+
+def test_reopen(tmp_path):
+    path = str(tmp_path / '.state' / '100.manifest')
+    m = Manifest(path)
+    assert len(m) == 0 and not os.path.exists(path)
+
+    m.set('photo1_1', url='https://cdn/1.jpg', path='Фото/1.jpg', size=10)
+    m.set('doc1_2', status='failed')
+    # entries are written before close
+    assert len(lines(path)) == 2
+    m.close()
+
+    m = Manifest(path)
+    assert len(m) == 2
+    assert m.done('photo1_1') and not m.done('doc1_2') and not m.done('video1_3')
+    assert 'doc1_2' in m and 'video1_3' not in m
+    assert m.get('photo1_1') == {'key': 'photo1_1', 'url': 'https://cdn/1.jpg', 'path': 'Фото/1.jpg',
+                                 'size': 10, 'status': 'ok'}
+    m.close()
+
+
+def test_compact(tmp_path):
+    path = str(tmp_path / '100.manifest')
+    m = Manifest(path)
+    m.set('doc1_2', status='failed')
+    m.set('photo1_1', path='1.jpg')
+    m.set('doc1_2', path='2.pdf')
+    assert len(lines(path)) == 3
+    m.close()
+
+    # later lines override earlier ones, overridden are removed on close
+    assert len(lines(path)) == 2
+    m = Manifest(path)
+    assert m.done('doc1_2') and m.get('doc1_2')['path'] == '2.pdf'
+    m.close()
+    assert len(lines(path)) == 2
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_broken_line(tmp_path):
+    # the last line may be cut by interrupted run
+    path = str(tmp_path / '100.manifest')
+    m = Manifest(path)
+    m.set('photo1_1', path='1.jpg')
+    m.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"key": "photo1_2", "ur')
+
+    m = Manifest(path)
+    assert len(m) == 1 and m.done('photo1_1')
+    m.set('photo1_2', path='2.jpg')
+    # entry written after the broken line is kept even if run is interrupted again
+    assert Manifest(path).done('photo1_2')
+    m.close()
+    assert len(lines(path)) == 2
+    assert len(Manifest(path)) == 2
@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+from modules.profiling import Profiler
+
+
+@pytest.mark.parametrize('cprofile', [False, True])
+def test_nested_targets(tmp_path, cprofile):
+    # menu's "dump all" runs targets inside its own one
+    profiler = Profiler(str(tmp_path / 'profile.json'), cprofile=cprofile)
+    with profiler.target('_dump_all'):
+        with profiler.stage('listing'):
+            pass
+        for name in ('dump_docs', 'dump_photo'):
+            with profiler.target(name):
+                with profiler.stage('download'):
+                    pass
+            with profiler.stage('between'):
+                pass
+    with profiler.stage('outside'):
+        pass
+    report = profiler.save()
+
+    targets = {t['name']: t for t in report['targets']}
+    assert list(targets) == ['_dump_all', 'dump_docs', 'dump_photo']
+    assert set(targets['_dump_all']['stages']) == {'listing', 'between'}
+    assert targets['_dump_all']['stages']['between']['calls'] == 2
+    for name in ('dump_docs', 'dump_photo'):
+        assert set(targets[name]['stages']) == {'download'}
+        assert bool(targets[name]['cprofile']) == cprofile
+
+    with open(str(tmp_path / 'profile.json'), 'r', encoding='utf-8') as f:
+        assert json.load(f)['targets'] == report['targets']
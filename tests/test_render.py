@@ -0,0 +1,63 @@
+"""
+MessageRenderer output is compared with data/render_synthetic.txt,
+rendered by message_handler of the baseline version from the same
+synthetic history: every attachment type and chat action, chains of
+forwarded messages, replies, date breaks and consecutive messages
+of one sender
+"""
+import io
+import os
+
+import pytest
+
+import synthetic
+from modules.messages import MessageRenderer
+from modules.profiles import Profiles
+
+EXPECTED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'render_synthetic.txt')
+
+
+class Dumper:
+    """Dumper stand-in with profiles of synthetic users"""
+    def __init__(self):
+        self._profiles = Profiles(':memory:', legacy=None)
+        self._profiles.add(synthetic.profiles())
+        self._settings = {'SAVE_DIALOG_ATTACHMENTS': True}
+
+
+@pytest.fixture(scope='module')
+def expected():
+    with open(EXPECTED, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+@pytest.fixture
+def history():
+    return synthetic.history(100, step=7200)
+
+
+def test_render(expected, history):
+    dmp = Dumper()
+    renderer = MessageRenderer(dmp)
+    f = io.StringIO()
+    for m in history:
+        renderer.render(m)
+    renderer.flush(f)
+    assert f.getvalue() == expected
+
+
+@pytest.mark.parametrize('page', [1, 7, 200])
+def test_render_pages(expected, history, page):
+    # history is written page by page, appended runs continue
+    # with sender and date of the last saved message
+    dmp = Dumper()
+    f = io.StringIO()
+    prev = prev_date = None
+    for i in range(0, len(history), page):
+        renderer = MessageRenderer(dmp, prev=prev, prev_date=prev_date)
+        for m in history[i:i+page]:
+            renderer.render(m)
+        renderer.flush(f)
+        prev, prev_date = renderer.prev, renderer.prev_date
+    assert f.getvalue() == expected
+
@@ -0,0 +1,29 @@
+import os
+
+from modules.state import load_state, state_path, update_state
+
+
+def test_update(tmp_path):
+    folder = str(tmp_path)
+    assert load_state(folder, 100) == {}
+
+    update_state(folder, 100, last_id=10, offset=120, compression=None)
+    assert load_state(folder, 100) == {'last_id': 10, 'offset': 120}
+
+    # None values are removed, the rest are kept
+    update_state(folder, 100, offset=None, stored=True)
+    assert load_state(folder, 100) == {'last_id': 10, 'stored': True}
+    assert load_state(folder, 200) == {}
+
+    assert os.listdir(os.path.dirname(state_path(folder, 100))) == ['100.json']
+
+
+def test_broken(tmp_path):
+    folder = str(tmp_path)
+    update_state(folder, 100, last_id=10)
+    with open(state_path(folder, 100), 'w', encoding='utf-8') as f:
+        f.write('{"last_id": 1')
+
+    assert load_state(folder, 100) == {}
+    update_state(folder, 100, last_id=20)
+    assert load_state(folder, 100) == {'last_id': 20}